@@ -0,0 +1,393 @@
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+from hparams import hparams
+
+
+def time_fn(fn, repeats):
+	'''Run fn "repeats" times (after one warmup call) and return the mean time per call in seconds
+	'''
+	fn()
+	start = time.time()
+	for _ in range(repeats):
+		fn()
+	return (time.time() - start) / repeats
+
+def report(name, baseline, candidate):
+	print('{}: baseline {:.2f} ms, candidate {:.2f} ms ({:.2f}x)'.format(
+		name, baseline * 1000, candidate * 1000, baseline / max(candidate, 1e-12)))
+
+def _load_or_synthesize_wav(args, hparams):
+	from datasets import audio
+	if args.wav:
+		return audio.load_wav(args.wav, sr=hparams.sample_rate)
+	#White noise in [-1, 1] is enough to exercise the STFT and mel projection
+	rng = np.random.RandomState(0)
+	return rng.uniform(-1., 1., int(args.seconds * hparams.sample_rate)).astype(np.float32)
+
+def bench_spectrograms(args, hparams):
+	'''Separate melspectrogram + linearspectrogram calls vs single STFT extraction (wav2spectrograms)
+	'''
+	from datasets import audio
+	wav = _load_or_synthesize_wav(args, hparams)
+
+	def separate():
+		return audio.melspectrogram(wav, hparams), audio.linearspectrogram(wav, hparams)
+
+	def combined():
+		magnitude = audio.magnitude_spectrogram(wav, hparams)
+		return audio.mel_from_magnitude(magnitude, hparams), audio.linear_from_magnitude(magnitude, hparams)
+
+	mel_a, linear_a = separate()
+	mel_b, linear_b = combined()
+	assert np.array_equal(mel_a, mel_b) and np.array_equal(linear_a, linear_b), 'outputs are not bit-compatible'
+
+	print('Utterance of {:.2f} sec ({} mel frames)'.format(len(wav) / hparams.sample_rate, mel_a.shape[1]))
+	report('spectrograms per utterance', time_fn(separate, args.repeats), time_fn(combined, args.repeats))
+
+
+class _LegacyBatcher:
+	'''Feeder._prepare_batch as it was before BatchBuilder (np.pad + np.stack + np.concatenate per tower), kept for comparison
+	'''
+	def __init__(self, hparams, pad, target_pad, token_pad):
+		self._hparams = hparams
+		self._pad = pad
+		self._target_pad = target_pad
+		self._token_pad = token_pad
+
+	def _prepare_batch(self, batches, outputs_per_step):
+		assert 0 == len(batches) % self._hparams.tacotron_num_gpus
+		size_per_device = int(len(batches) / self._hparams.tacotron_num_gpus)
+		inputs = None
+		speaker_labels=None
+		language_labels=None
+		mel_targets = None
+		token_targets = None
+		linear_targets = None
+		targets_lengths = None
+
+		split_infos = []
+
+		targets_lengths = np.asarray([x[-1] for x in batches], dtype=np.int32) #Used to mask loss
+		input_lengths = np.asarray([len(x[0]) for x in batches], dtype=np.int32)
+
+		for i in range(self._hparams.tacotron_num_gpus):
+			batch = batches[size_per_device*i:size_per_device*(i+1)]
+			input_cur_device, input_max_len = self._prepare_inputs([x[0] for x in batch])
+			inputs = np.concatenate((inputs, input_cur_device), axis=1) if inputs is not None else input_cur_device
+			speaker_label_cur_device = np.asarray([x[1] for x in batch], dtype=np.int32)
+			speaker_labels = np.concatenate((speaker_labels, speaker_label_cur_device),axis=0) if speaker_labels is not None else speaker_label_cur_device
+			language_label_cur_device = np.asarray([x[2] for x in batch], dtype=np.int32)
+			language_labels = np.concatenate((language_labels, language_label_cur_device),axis=0) if language_labels is not None else language_label_cur_device
+			mel_target_cur_device, mel_target_max_len = self._prepare_targets([x[3] for x in batch], outputs_per_step)
+			mel_targets = np.concatenate(( mel_targets, mel_target_cur_device), axis=1) if mel_targets is not None else mel_target_cur_device
+
+			#Pad sequences with 1 to infer that the sequence is done
+			token_target_cur_device, token_target_max_len = self._prepare_token_targets([x[4] for x in batch], outputs_per_step)
+			token_targets = np.concatenate((token_targets, token_target_cur_device),axis=1) if token_targets is not None else token_target_cur_device
+			linear_targets_cur_device, linear_target_max_len = self._prepare_targets([x[5] for x in batch], outputs_per_step)
+			linear_targets = np.concatenate((linear_targets, linear_targets_cur_device), axis=1) if linear_targets is not None else linear_targets_cur_device
+			split_infos.append([input_max_len, mel_target_max_len, token_target_max_len, linear_target_max_len])
+		split_infos = np.asarray(split_infos, dtype=np.int32)
+		return (inputs, speaker_labels, language_labels, input_lengths, mel_targets, token_targets, linear_targets, targets_lengths, split_infos)
+
+	def _prepare_inputs(self, inputs):
+		max_len = max([len(x) for x in inputs])
+		return np.stack([self._pad_input(x, max_len) for x in inputs]), max_len
+
+	def _prepare_targets(self, targets, alignment):
+		max_len = max([len(t) for t in targets])
+		data_len = self._round_up(max_len, alignment)
+		return np.stack([self._pad_target(t, data_len) for t in targets]), data_len
+
+	def _prepare_token_targets(self, targets, alignment):
+		max_len = max([len(t) for t in targets]) + 1
+		data_len = self._round_up(max_len, alignment)
+		return np.stack([self._pad_token_target(t, data_len) for t in targets]), data_len
+
+	def _pad_input(self, x, length):
+		return np.pad(x, (0, length - x.shape[0]), mode='constant', constant_values=self._pad)
+
+	def _pad_target(self, t, length):
+		return np.pad(t, [(0, length - t.shape[0]), (0, 0)], mode='constant', constant_values=self._target_pad)
+
+	def _pad_token_target(self, t, length):
+		return np.pad(t, (0, length - t.shape[0]), mode='constant', constant_values=self._token_pad)
+
+	def _round_up(self, x, multiple):
+		remainder = x % multiple
+		return x if remainder == 0 else x + multiple - remainder
+
+def _synthesize_examples(hparams, count, rng):
+	examples = []
+	for _ in range(count):
+		mel_length = rng.randint(100, hparams.max_mel_frames)
+		examples.append((
+			rng.randint(1, 80, rng.randint(20, 200)).astype(np.int32),
+			np.asarray(rng.randint(10), dtype=np.int32),
+			np.asarray(rng.randint(2), dtype=np.int32),
+			rng.uniform(-4., 4., (mel_length, hparams.num_mels)).astype(np.float32),
+			np.zeros(mel_length - 1),
+			rng.uniform(-4., 4., (mel_length, hparams.num_freq)).astype(np.float32),
+			mel_length))
+	return examples
+
+def bench_prepare_batch(args, hparams):
+	'''Legacy per example np.pad/np.stack/np.concatenate batch assembly vs preallocated BatchBuilder
+	'''
+	from tacotron.batch_builder import BatchBuilder
+	pad, target_pad, token_pad = 0, -hparams.max_abs_value if hparams.symmetric_mels else 0., 1.
+	rng = np.random.RandomState(0)
+	batch = _synthesize_examples(hparams, hparams.tacotron_batch_size, rng)
+	r = hparams.outputs_per_step
+
+	legacy = _LegacyBatcher(hparams, pad, target_pad, token_pad)
+	builder = BatchBuilder(hparams, pad, target_pad, token_pad)
+	for a, b in zip(legacy._prepare_batch(batch, r), builder.build(batch, r)):
+		assert a.shape == b.shape and np.array_equal(a.astype(b.dtype), b), 'batches differ'
+
+	print('Batch of {} examples over {} tower(s)'.format(len(batch), hparams.tacotron_num_gpus))
+	report('batch assembly', time_fn(lambda: legacy._prepare_batch(batch, r), args.repeats),
+		time_fn(lambda: builder.build(batch, r), args.repeats))
+
+def _load_targets(directory, keys, mmap):
+	'''Loads every target of keys and pads it into a batch buffer, like the feeder does.
+	Runs in a fresh process, returns (examples/sec, peak RSS in MB)
+	'''
+	import resource
+	from datasets.feature_store import FeatureReader
+	reader = FeatureReader(directory, mmap=mmap)
+	buffer = None
+	start = time.time()
+	for key in keys:
+		target = reader.load(key)
+		if buffer is None or buffer.shape[0] < len(target) or buffer.shape[1:] != target.shape[1:]:
+			buffer = np.empty((max(len(target), 1000), ) + target.shape[1:], dtype=np.float32)
+		buffer[:len(target)] = target
+		del target
+	elapsed = time.time() - start
+	return len(keys) / elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def bench_target_loading(args, hparams):
+	'''np.load into memory vs memory-mapped .npy targets (FeatureReader mmap switch), each in a fresh process
+	'''
+	temporary = None
+	try:
+		if args.input_dir:
+			directory = args.input_dir
+			keys = sorted(f for f in os.listdir(directory) if f.endswith('.npy'))[:args.examples]
+		else:
+			#Synthetic linear targets, the largest arrays the feeder reads, removed once measured
+			temporary = tempfile.TemporaryDirectory(prefix='targets-')
+			directory = temporary.name
+			rng = np.random.RandomState(0)
+			keys = []
+			for i in range(args.examples):
+				keys.append('linear-{:05d}.npy'.format(i))
+				frames = rng.randint(100, hparams.max_mel_frames)
+				np.save(os.path.join(directory, keys[-1]), rng.uniform(-4., 4., (frames, hparams.num_freq)).astype(np.float32))
+		if not keys:
+			raise ValueError('No .npy targets found in {}'.format(directory))
+
+		context = multiprocessing.get_context('spawn')
+		#First pass warms the page cache so both loaders read from memory
+		with context.Pool(1) as pool:
+			pool.apply(_load_targets, (directory, keys, False))
+		results = {}
+		for mmap in (False, True):
+			with context.Pool(1) as pool:
+				results[mmap] = pool.apply(_load_targets, (directory, keys, mmap))
+	finally:
+		if temporary is not None:
+			temporary.cleanup()
+
+	print('{} targets from {}'.format(len(keys), directory))
+	for mmap, name in ((False, 'np.load'), (True, 'mmap')):
+		print('{:>8}: {:.1f} examples/sec, peak RSS {:.1f} MB'.format(name, *results[mmap]))
+	print('speedup: {:.2f}x'.format(results[True][0] / results[False][0]))
+
+
+def _conv_shapes(layers, kernel_size, in_channels, channels):
+	#Kernel, bias and batch norm gamma/beta of each layer
+	shapes = []
+	for _ in range(layers):
+		shapes += [[kernel_size, in_channels, channels], [channels], [channels], [channels]]
+		in_channels = channels
+	return shapes
+
+def _lstm_shapes(layers, in_size, units):
+	shapes = []
+	for _ in range(layers):
+		shapes += [[in_size + units, 4 * units], [4 * units]]
+		in_size = units
+	return shapes
+
+def _tacotron_gradient_shapes(hparams):
+	'''Approximate variable shapes of the model (a few large kernels and many small vectors), without building it
+	'''
+	from tacotron.utils.symbols import symbols
+	hp = hparams
+	encoder_outputs = 2 * hp.encoder_lstm_units + hp.speaker_dim + hp.language_dim + hp.VAE_D_size
+	shapes = [[len(symbols), hp.embedding_dim], [hp.speaker_num, hp.speaker_dim], [hp.language_num, hp.language_dim]]
+	shapes += _conv_shapes(hp.enc_conv_num_layers, hp.enc_conv_kernel_size[0], hp.embedding_dim, hp.enc_conv_channels)
+	shapes += 2 * _lstm_shapes(1, hp.enc_conv_channels, hp.encoder_lstm_units)
+	shapes += _conv_shapes(hp.VAE_conv_num_layers, hp.VAE_conv_kernel_size[0], hp.num_mels, hp.VAE_conv_channels)
+	shapes += _lstm_shapes(hp.VAE_lstm_num_layers, hp.VAE_conv_channels, hp.VAE_lstm_layer_size)
+	shapes += [[hp.VAE_lstm_layer_size, hp.VAE_D_size], [hp.VAE_D_size]] * 2
+	sizes = [hp.num_mels] + hp.prenet_layers
+	shapes += [shape for i, o in zip(sizes, sizes[1:]) for shape in ([i, o], [o])]
+	shapes += _lstm_shapes(hp.decoder_layers, hp.prenet_layers[-1] + encoder_outputs, hp.decoder_lstm_units)
+	shapes += [[hp.decoder_lstm_units, hp.attention_dim], [encoder_outputs, hp.attention_dim], [hp.attention_dim], [hp.attention_dim],
+		[hp.attention_kernel[0], 1, hp.attention_filters], [hp.attention_filters, hp.attention_dim]]
+	shapes += [[hp.decoder_lstm_units + encoder_outputs, hp.num_mels * hp.outputs_per_step], [hp.num_mels * hp.outputs_per_step],
+		[hp.decoder_lstm_units + encoder_outputs, hp.outputs_per_step], [hp.outputs_per_step]]
+	shapes += _conv_shapes(hp.postnet_num_layers, hp.postnet_kernel_size[0], hp.num_mels, hp.postnet_channels)
+	shapes += [[hp.postnet_channels, hp.num_mels], [hp.num_mels]]
+	if hp.predict_linear:
+		for k in range(1, hp.cbhg_kernels + 1):
+			shapes += _conv_shapes(1, k, hp.num_mels, hp.cbhg_conv_channels)
+		shapes += _conv_shapes(1, hp.cbhg_projection_kernel_size, hp.cbhg_kernels * hp.cbhg_conv_channels, hp.cbhg_projection)
+		shapes += _conv_shapes(1, hp.cbhg_projection_kernel_size, hp.cbhg_projection, hp.num_mels)
+		shapes += [[hp.cbhg_highway_units, hp.cbhg_highway_units], [hp.cbhg_highway_units]] * 2 * hp.cbhg_highwaynet_layers
+		shapes += 2 * [[hp.cbhg_highway_units + hp.cbhg_rnn_units, 3 * hp.cbhg_rnn_units], [3 * hp.cbhg_rnn_units]]
+		shapes += [[2 * hp.cbhg_rnn_units, hp.num_freq], [hp.num_freq]]
+	return shapes
+
+def _legacy_average_gradients(tower_gradients):
+	'''Tacotron.add_optimizer tower averaging as it was before average_gradients (expand_dims + concat + reduce_mean), kept for comparison
+	'''
+	import tensorflow as tf
+	avg_grads = []
+	vars = []
+	for grad_and_vars in zip(*tower_gradients):
+		grads = []
+		for g,_ in grad_and_vars:
+			grads.append(tf.expand_dims(g, 0))
+		grad = tf.concat(axis=0, values=grads)
+		grad = tf.reduce_mean(grad, 0)
+		avg_grads.append(grad)
+		vars.append(grad_and_vars[0][1])
+	return list(zip(avg_grads, vars))
+
+def bench_gradient_reduction(args, hparams):
+	'''Legacy stacked reduce_mean vs add_n (and fused add_n) averaging of the gradients of 1, 2 and 4 CPU simulated towers
+	'''
+	import tensorflow as tf
+	from tacotron.models.gradients import average_gradients
+	shapes = _tacotron_gradient_shapes(hparams)
+	rng = np.random.RandomState(0)
+	print('{} gradients, {:.1f} MB per tower, fusion buffers of {:.1f} MB'.format(
+		len(shapes), sum(np.prod(shape) for shape in shapes) * 4 / 1024 ** 2, args.fusion_bytes / 1024 ** 2))
+
+	for towers in (1, 2, 4):
+		graph = tf.Graph()
+		with graph.as_default():
+			with tf.device('/cpu:0'):
+				variables = [tf.Variable(rng.uniform(-1., 1., shape).astype(np.float32)) for shape in shapes]
+			#Gradients are computed on each tower at every run, like the real ones
+			tower_gradients = []
+			for t in range(towers):
+				with tf.device('/cpu:{}'.format(t)):
+					tower_gradients.append([(v * float(t + 1), v) for v in variables])
+			candidates = []
+			for name, averages in (('legacy', _legacy_average_gradients(tower_gradients)), ('add_n', average_gradients(tower_gradients)),
+					('add_n fused', average_gradients(tower_gradients, args.fusion_bytes))):
+				gradients = [g for g, _ in averages]
+				candidates.append((name, gradients, tf.group(*gradients)))
+			initializer = tf.variables_initializer(variables)
+
+		config = tf.ConfigProto(device_count={'CPU': towers})
+		with tf.Session(graph=graph, config=config) as sess:
+			sess.run(initializer)
+			reference = sess.run(candidates[0][1])
+			times = {}
+			for name, gradients, op in candidates:
+				assert all(np.allclose(a, b) for a, b in zip(reference, sess.run(gradients))), '{} averages differ'.format(name)
+				times[name] = time_fn(lambda: sess.run(op), args.repeats)
+
+		for name in ('add_n', 'add_n fused'):
+			report('{} tower(s), {}'.format(towers, name), times['legacy'], times[name])
+
+def _legacy_split_func(x, split_pos):
+	'''Tacotron.initialize tower split as it was before tf.split (run through tf.py_func), kept for comparison
+	'''
+	rst = []
+	start = 0
+	for i in range(split_pos.shape[0]):
+		rst.append(x[:,start:start+split_pos[i]])
+		start += split_pos[i]
+	return rst
+
+def bench_tower_split(args, hparams):
+	'''tf.py_func vs native tf.split per tower slicing of a training batch (inputs, mel, token and linear targets), 1, 2 and 4 towers
+	'''
+	import tensorflow as tf
+	from tacotron.batch_builder import BatchBuilder
+	pad, target_pad, token_pad = 0, -hparams.max_abs_value if hparams.symmetric_mels else 0., 1.
+	rng = np.random.RandomState(0)
+	examples = _synthesize_examples(hparams, 4 * (hparams.tacotron_batch_size // 4), rng)
+	r = hparams.outputs_per_step
+
+	for towers in (1, 2, 4):
+		tower_hparams = SimpleNamespace(**dict(hparams.values(), tacotron_num_gpus=towers))
+		batch = BatchBuilder(tower_hparams, pad, target_pad, token_pad).build(examples, r)
+		fields = [batch[0], batch[4], batch[5], batch[6]]
+		split_infos = batch[8]
+
+		graph = tf.Graph()
+		with graph.as_default():
+			#Batches reach the model as graph values (dequeued), not as feeds
+			tensors = [tf.Variable(field, trainable=False) for field in fields]
+			infos = tf.constant(split_infos)
+			legacy = [tf.py_func(_legacy_split_func, [x, infos[:, k]], [x.dtype.base_dtype] * towers, stateful=False) for k, x in enumerate(tensors)]
+			native = [tf.split(x, infos[:, k], axis=1, num=towers) for k, x in enumerate(tensors)]
+			#Consumers of the towers, like the model, so that the slices are materialized
+			legacy_op, native_op = [tf.group(*[tf.reduce_sum(t) for parts in splits for t in parts]) for splits in (legacy, native)]
+			initializer = tf.variables_initializer(tensors)
+
+		with tf.Session(graph=graph) as sess:
+			sess.run(initializer)
+			for a, b in zip(sess.run(legacy), sess.run(native)):
+				assert all(np.array_equal(x, y) for x, y in zip(a, b)), 'tower slices differ'
+			print('Batch of {} examples over {} tower(s), {:.1f} MB'.format(len(examples), towers, sum(field.nbytes for field in fields) / 1024 ** 2))
+			report('{} tower(s) split'.format(towers), time_fn(lambda: sess.run(legacy_op), args.repeats),
+				time_fn(lambda: sess.run(native_op), args.repeats))
+
+
+_benchmarks = {
+	'spectrograms': bench_spectrograms,
+	'prepare_batch': bench_prepare_batch,
+	'target_loading': bench_target_loading,
+	'gradient_reduction': bench_gradient_reduction,
+	'tower_split': bench_tower_split,
+}
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--bench', default='all', help='One of {} or "all"'.format(sorted(_benchmarks)))
+	parser.add_argument('--hparams', default='',
+		help='Hyperparameter overrides as a comma-separated list of name=value pairs')
+	parser.add_argument('--repeats', type=int, default=20, help='Number of timed iterations per candidate')
+	parser.add_argument('--wav', default=None, help='Optional wav file to use instead of synthetic audio')
+	parser.add_argument('--seconds', type=float, default=5., help='Length of the synthetic utterance')
+	parser.add_argument('--input_dir', default=None, help='Optional directory of preprocessed .npy targets (e.g. training_data/linear)')
+	parser.add_argument('--examples', type=int, default=200, help='Number of targets loaded (or synthesized) by target_loading')
+	parser.add_argument('--fusion_bytes', type=int, default=4 * 1024 ** 2, help='Fused buffer size of the gradient_reduction benchmark')
+	args = parser.parse_args()
+
+	modified_hp = hparams.parse(args.hparams)
+	names = sorted(_benchmarks) if args.bench == 'all' else [args.bench]
+	for name in names:
+		if name not in _benchmarks:
+			raise ValueError('Unknown benchmark: {}, accepted: {}'.format(name, sorted(_benchmarks)))
+		print('== {} =='.format(name))
+		_benchmarks[name](args, modified_hp)
+
+
+if __name__ == '__main__':
+	main()
@@ -1,13 +1,13 @@
-from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 
 import numpy as np
 import os
 import re
-from datasets import audio
+from datasets import audio, feature_store, scheduler
+from datasets.scheduler import Utterance
 
 
-def build_from_path_CN(hparams, speaker_num, lan_num, input_dir, use_prosody, mel_dir, linear_dir, wav_dir, n_jobs=12, tqdm=lambda x: x):
+def build_from_path_CN(hparams, speaker_num, lan_num, input_dir, use_prosody, mel_dir, linear_dir, wav_dir, n_jobs=12, tqdm=lambda x: x, manifest=None):
   """
   Preprocesses the TTS.HUawei.zhcmn.F.Deng dataset from a gven input path to given output directories
 
@@ -24,15 +24,20 @@ def build_from_path_CN(hparams, speaker_num, lan_num, input_dir, use_prosody, me
     - wav_dir: output directory of the preprocessed speech audio dataset
     - n_jobs: Optional, number of worker process to parallelize across
     - tqdm: Optional, provides a nice progress bar
+    - manifest: Optional, datasets.manifest.Manifest used to skip utterances that are already up to date
 
   Returns:
     - A list of tuple describing the train examples. This should be written to train.txt
   """
 
-  # We use ProcessPoolExecutor to parallelize across processes, this is just for
-  # optimization purposes and it can be omited
-  executor = ProcessPoolExecutor(max_workers=n_jobs)
-  futures = []
+  # We use a single bounded ProcessPoolExecutor (see datasets/scheduler.py) to parallelize across processes,
+  # this is just for optimization purposes and it can be omited
+  return list(tqdm(scheduler.run(utterances_CN(hparams, speaker_num, lan_num, input_dir, use_prosody, mel_dir, linear_dir, wav_dir), n_jobs, manifest)))
+
+def utterances_CN(hparams, speaker_num, lan_num, input_dir, use_prosody, mel_dir, linear_dir, wav_dir):
+  """
+  Yields the scheduler.Utterance jobs of build_from_path_CN, lazily so they can be chained with other datasets
+  """
   prompt_path = os.path.join(input_dir, 'text')
   input_wav_dir = os.path.join(input_dir, 'wave')
   content = _read_labels(prompt_path)
@@ -43,11 +48,10 @@ def build_from_path_CN(hparams, speaker_num, lan_num, input_dir, use_prosody, me
       sen_id, text = res
       basename = '05{:04}'.format(sen_id)
       wav_path = os.path.join(input_wav_dir, '01{:04}.wav'.format(sen_id))
-      futures.append(executor.submit(partial(_process_utterance, mel_dir, linear_dir, wav_dir, basename, wav_path, text, speaker_num, lan_num, hparams)))
-
-  return [future.result() for future in tqdm(futures) if future.result() is not None]
+      yield Utterance(partial(_process_utterance, mel_dir, linear_dir, wav_dir, basename, wav_path, text, speaker_num, lan_num, hparams),
+        basename, wav_path, text, speaker_num, lan_num)
 
-def build_from_path_EN(hparams, speaker_num, lan_num, input_dir, mel_dir, linear_dir, wav_dir, n_jobs=12, tqdm=lambda x: x):
+def build_from_path_EN(hparams, speaker_num, lan_num, input_dir, mel_dir, linear_dir, wav_dir, n_jobs=12, tqdm=lambda x: x, manifest=None):
   """
   Preprocesses the TTS.Huawei.enus.F.XuYue dataset from a gven input path to given output directories
 
@@ -64,15 +68,20 @@ def build_from_path_EN(hparams, speaker_num, lan_num, input_dir, mel_dir, linear
     - wav_dir: output directory of the preprocessed speech audio dataset
     - n_jobs: Optional, number of worker process to parallelize across
     - tqdm: Optional, provides a nice progress bar
+    - manifest: Optional, datasets.manifest.Manifest used to skip utterances that are already up to date
 
   Returns:
     - A list of tuple describing the train examples. This should be written to train.txt
   """
 
-  # We use ProcessPoolExecutor to parallelize across processes, this is just for
-  # optimization purposes and it can be omited
-  executor = ProcessPoolExecutor(max_workers=n_jobs)
-  futures = []
+  # We use a single bounded ProcessPoolExecutor (see datasets/scheduler.py) to parallelize across processes,
+  # this is just for optimization purposes and it can be omited
+  return list(tqdm(scheduler.run(utterances_EN(hparams, speaker_num, lan_num, input_dir, mel_dir, linear_dir, wav_dir), n_jobs, manifest)))
+
+def utterances_EN(hparams, speaker_num, lan_num, input_dir, mel_dir, linear_dir, wav_dir):
+  """
+  Yields the scheduler.Utterance jobs of build_from_path_EN, lazily so they can be chained with other datasets
+  """
   prompt_path = os.path.join(input_dir, 'text')
   input_wav_dir = os.path.join(input_dir, 'wave')
   content = _read_labels(prompt_path)
@@ -83,9 +92,8 @@ def build_from_path_EN(hparams, speaker_num, lan_num, input_dir, mel_dir, linear
       sen_id, text = res
       basename = '{:06}'.format(sen_id)
       wav_path = os.path.join(input_wav_dir, '{}.wav'.format(basename))
-      futures.append(executor.submit(partial(_process_utterance, mel_dir, linear_dir, wav_dir, basename, wav_path, text, speaker_num, lan_num, hparams)))
-
-  return [future.result() for future in tqdm(futures) if future.result() is not None]
+      yield Utterance(partial(_process_utterance, mel_dir, linear_dir, wav_dir, basename, wav_path, text, speaker_num, lan_num, hparams),
+        basename, wav_path, text, speaker_num, lan_num)
 
 
 
@@ -244,13 +252,13 @@ def _process_utterance(mel_dir, linear_dir, wav_dir, index, wav_path, text, spea
     return None
   out, mel_spectrogram, linear_spectrogram, time_steps, mel_frames = ret
 
-  # Write the spectrogram and audio to disk
+  # Write the spectrogram and audio to disk (packed shards or .npy files, see datasets/feature_store.py)
   audio_filename = 'audio-{}.npy'.format(index)
   mel_filename = 'mel-{}.npy'.format(index)
   linear_filename = 'linear-{}.npy'.format(index)
-  np.save(os.path.join(wav_dir, audio_filename), out.astype(np.float32), allow_pickle=False)
-  np.save(os.path.join(mel_dir, mel_filename), mel_spectrogram.T, allow_pickle=False)
-  np.save(os.path.join(linear_dir, linear_filename), linear_spectrogram.T, allow_pickle=False)
+  feature_store.save(wav_dir, audio_filename, out.astype(np.float32), hparams)
+  feature_store.save(mel_dir, mel_filename, mel_spectrogram.T, hparams)
+  feature_store.save(linear_dir, linear_filename, linear_spectrogram.T, hparams)
 
   # Return a tuple describing this training example
   return (audio_filename, mel_filename, linear_filename, time_steps, mel_frames, text, speaker_num, lan_num, )
@@ -56,22 +56,31 @@ def get_hop_size(hparams):
 		hop_size = int(hparams.frame_shift_ms / 1000 * hparams.sample_rate)
 	return hop_size
 
-def linearspectrogram(wav, hparams):
+def magnitude_spectrogram(wav, hparams):
+	'''Preemphasize and STFT the wav once, returning |D| shared by the mel and linear features'''
 	D = _stft(preemphasis(wav, hparams.preemphasis, hparams.preemphasize), hparams)
-	S = _amp_to_db(np.abs(D), hparams) - hparams.ref_level_db
+	return np.abs(D)
+
+def linear_from_magnitude(magnitude, hparams):
+	S = _amp_to_db(magnitude, hparams) - hparams.ref_level_db
 
 	if hparams.signal_normalization:
 		return _normalize(S, hparams)
 	return S
 
-def melspectrogram(wav, hparams):
-	D = _stft(preemphasis(wav, hparams.preemphasis, hparams.preemphasize), hparams)
-	S = _amp_to_db(_linear_to_mel(np.abs(D), hparams), hparams) - hparams.ref_level_db
+def mel_from_magnitude(magnitude, hparams):
+	S = _amp_to_db(_linear_to_mel(magnitude, hparams), hparams) - hparams.ref_level_db
 
 	if hparams.signal_normalization:
 		return _normalize(S, hparams)
 	return S
 
+def linearspectrogram(wav, hparams):
+	return linear_from_magnitude(magnitude_spectrogram(wav, hparams), hparams)
+
+def melspectrogram(wav, hparams):
+	return mel_from_magnitude(magnitude_spectrogram(wav, hparams), hparams)
+
 def inv_linear_spectrogram(linear_spectrogram, hparams):
 	'''Converts linear spectrogram to waveform using librosa'''
 	if hparams.signal_normalization:
@@ -230,15 +239,18 @@ def wav2spectrograms(wav, hparams):
 	out = wav
 	constant_values = 0.
 
-	# Compute the mel scale spectrogram from the wav
-	mel_spectrogram = melspectrogram(wav, hparams).astype(np.float32)
-	mel_frames = mel_spectrogram.shape[1]
+	#Run the STFT once, both mel and linear spectrograms are derived from the same magnitudes
+	magnitude = magnitude_spectrogram(wav, hparams)
+	mel_frames = magnitude.shape[1]
 
 	if mel_frames > hparams.max_mel_frames and hparams.clip_mels_length:
 		return None
 
+	# Compute the mel scale spectrogram from the wav
+	mel_spectrogram = mel_from_magnitude(magnitude, hparams).astype(np.float32)
+
 	#Compute the linear scale spectrogram from the wav
-	linear_spectrogram = linearspectrogram(wav, hparams).astype(np.float32)
+	linear_spectrogram = linear_from_magnitude(magnitude, hparams).astype(np.float32)
 	linear_frames = linear_spectrogram.shape[1]
 
 	#sanity check
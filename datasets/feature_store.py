@@ -0,0 +1,191 @@
+import glob
+import os
+import time
+
+import numpy as np
+
+#Shards are aligned so every array starts on a cache line (and any dtype boundary)
+_alignment = 64
+_data_suffix = '.bin'
+_index_suffix = '.idx'
+
+#One open writer per output directory, per process (preprocessing workers never share a shard)
+_writers = {}
+#Readers cached per directory for path based loading (see load())
+_readers = {}
+
+
+class ShardWriter:
+	"""
+		Appends arrays to a large contiguous shard file and records (key, dtype, shape, offset) in a text index.
+
+		Shard layout:
+			shard-<run>-<pid>-<n>.bin  raw array bytes, each array aligned to 64 bytes
+			shard-<run>-<pid>-<n>.idx  one 'key|dtype|shape|offset' line per array
+
+		The data is flushed before its index line is written, so an interrupted run never leaves
+		an index entry pointing to missing bytes.
+	"""
+
+	def __init__(self, directory, max_shard_bytes):
+		self._directory = directory
+		self._max_shard_bytes = max_shard_bytes
+		self._prefix = 'shard-{:x}-{}'.format(int(time.time()), os.getpid())
+		self._shard = -1
+		self._data = None
+		self._index = None
+		self.pid = os.getpid()
+		self._next_shard()
+
+	def _next_shard(self):
+		self.close()
+		self._shard += 1
+		name = os.path.join(self._directory, '{}-{:04d}'.format(self._prefix, self._shard))
+		self._data = open(name + _data_suffix, 'ab')
+		self._index = open(name + _index_suffix, 'a', encoding='utf-8')
+		self._offset = self._data.tell()
+
+	def write(self, key, array):
+		array = np.ascontiguousarray(array)
+		if self._offset > 0 and self._offset + array.nbytes > self._max_shard_bytes:
+			self._next_shard()
+
+		#Pad up to the next aligned offset
+		padding = -self._offset % _alignment
+		if padding:
+			self._data.write(b'\0' * padding)
+			self._offset += padding
+
+		offset = self._offset
+		self._data.write(array.tobytes())
+		self._data.flush()
+		self._offset += array.nbytes
+
+		self._index.write('{}|{}|{}|{}\n'.format(key, array.dtype.str, ','.join(str(d) for d in array.shape), offset))
+		self._index.flush()
+
+	def close(self):
+		if self._data is not None:
+			self._data.close()
+			self._index.close()
+			self._data = self._index = None
+
+
+class FeatureReader:
+	"""
+		Loads preprocessed arrays from a feature directory.
+
+		If the directory holds shards, arrays are returned as zero-copy views on a read-only
+		memory map of their shard. Otherwise it falls back to the per-utterance .npy files,
+		read into memory or, with mmap=True, memory-mapped read-only as well.
+	"""
+
+	def __init__(self, directory, mmap=False):
+		self._directory = directory
+		self._mmap_mode = 'r' if mmap else None
+		self._entries = {}
+		self._maps = {}
+
+		#Shard names start with their run timestamp, so entries rewritten by a later (incremental) run win
+		for index_path in sorted(glob.glob(os.path.join(directory, '*' + _index_suffix))):
+			shard = index_path[:-len(_index_suffix)] + _data_suffix
+			with open(index_path, encoding='utf-8') as f:
+				for line in f:
+					key, dtype, shape, offset = line.rstrip('\n').split('|')
+					shape = tuple(int(d) for d in shape.split(',') if d != '')
+					self._entries[key] = (shard, np.dtype(dtype), shape, int(offset))
+
+	@property
+	def sharded(self):
+		return len(self._entries) > 0
+
+	def __contains__(self, key):
+		if self.sharded:
+			return key in self._entries
+		return os.path.isfile(os.path.join(self._directory, key))
+
+	def __len__(self):
+		return len(self._entries)
+
+	def load(self, key):
+		if not self.sharded:
+			return np.load(os.path.join(self._directory, key), mmap_mode=self._mmap_mode)
+
+		shard, dtype, shape, offset = self._entries[key]
+		data = self._maps.get(shard)
+		if data is None:
+			data = self._maps[shard] = np.memmap(shard, dtype=np.uint8, mode='r')
+		return np.ndarray(shape, dtype=dtype, buffer=data, offset=offset)
+
+	def locate(self, key):
+		"""Returns where the raw bytes of an array lie: (path, offset, dtype, shape, fortran_order)
+
+		Lets readers outside numpy (e.g. tf.data byte range reads) load arrays, .npy headers are read (not the data).
+		"""
+		if self.sharded:
+			shard, dtype, shape, offset = self._entries[key]
+			return shard, offset, dtype, shape, False
+
+		path = os.path.join(self._directory, key)
+		with open(path, 'rb') as f:
+			version = np.lib.format.read_magic(f)
+			read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+			shape, fortran_order, dtype = read_header(f)
+			return path, f.tell(), dtype, shape, fortran_order
+
+
+def save(directory, filename, array, hparams):
+	"""
+	Writes a preprocessed array under the given filename
+
+	With hparams.use_feature_store, the array is appended to this process's current shard in
+	directory (filename becomes its key in the shard index). Otherwise it is saved as a standalone .npy file.
+	"""
+	if not hparams.use_feature_store:
+		np.save(os.path.join(directory, filename), array, allow_pickle=False)
+		return
+
+	writer = _writers.get(directory)
+	#Workers forked from a process that already wrote must not append to the parent's shard
+	if writer is None or writer.pid != os.getpid():
+		writer = _writers[directory] = ShardWriter(directory, hparams.feature_shard_bytes)
+	writer.write(filename, array)
+
+def remove_unreferenced(directory, keys):
+	"""
+	Deletes the shards of directory holding no live array of keys (entries rewritten by a later shard are not live)
+
+	Returns:
+		- the number of shards and bytes removed
+	"""
+	#Same resolution as FeatureReader: the latest shard (by name) holding a key wins
+	live = {}
+	index_paths = sorted(glob.glob(os.path.join(directory, '*' + _index_suffix)))
+	for index_path in index_paths:
+		with open(index_path, encoding='utf-8') as f:
+			for line in f:
+				live[line.split('|', 1)[0]] = index_path
+	referenced = set(live[key] for key in keys if key in live)
+
+	removed = removed_bytes = 0
+	for index_path in index_paths:
+		if index_path in referenced:
+			continue
+		shard = index_path[:-len(_index_suffix)] + _data_suffix
+		for path in (shard, index_path):
+			if os.path.isfile(path):
+				removed_bytes += os.path.getsize(path)
+				os.remove(path)
+		removed += 1
+	_readers.pop(directory, None)
+	return removed, removed_bytes
+
+def load(path):
+	"""
+	Loads the array saved at path (directory/filename), from shards or .npy files
+	"""
+	directory, filename = os.path.split(path)
+	reader = _readers.get(directory)
+	if reader is None:
+		reader = _readers[directory] = FeatureReader(directory)
+	return reader.load(filename)
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import Future
+
+from datasets import feature_store
+
+#Every hparam that changes the content (or storage layout) of the preprocessed audio/mel/linear arrays
+_audio_hparams = [
+	'sample_rate', 'n_fft', 'hop_size', 'frame_shift_ms', 'win_size', 'num_mels', 'num_freq', 'fmin', 'fmax',
+	'rescale', 'rescaling_max', 'trim_silence', 'trim_fft_size', 'trim_hop_size', 'trim_top_db',
+	'preemphasize', 'preemphasis', 'min_level_db', 'ref_level_db', 'signal_normalization',
+	'allow_clipping_in_normalization', 'symmetric_mels', 'max_abs_value', 'use_lws',
+	'clip_mels_length', 'max_mel_frames', 'use_feature_store',
+]
+
+
+def hparams_fingerprint(hparams):
+	values = hparams.values()
+	audio_values = {name: values[name] for name in _audio_hparams}
+	return hashlib.sha1(json.dumps(audio_values, sort_keys=True).encode('utf-8')).hexdigest()
+
+def file_hash(path, chunk_size=1 << 20):
+	sha1 = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(chunk_size), b''):
+			sha1.update(chunk)
+	return sha1.hexdigest()
+
+def _run_and_hash(job, wav_path):
+	"""Runs job and fingerprints its wav in the worker process
+
+	Returns:
+		- (row, (size, mtime, sha1) of the wav), the fingerprint is None if the wav is missing
+	"""
+	row = job()
+	try:
+		stat = os.stat(wav_path)
+	except OSError:
+		return row, None
+	return row, (stat.st_size, stat.st_mtime_ns, file_hash(wav_path))
+
+
+class Manifest:
+	"""
+		Records, per utterance, the source wav (size, mtime, sha1) and the audio hparams its features were extracted with.
+
+		Records are appended to <out_dir>/manifest.jsonl as soon as an utterance is processed, so a crashed run
+		resumes where it stopped. On a later run, utterances whose wav and audio hparams are unchanged and whose
+		features are still stored reuse their recorded train.txt row instead of being extracted again.
+		Closing the manifest deletes the feature shards no up to date record refers to anymore.
+	"""
+
+	def __init__(self, out_dir, hparams, feature_dirs):
+		"""
+		Args:
+			- out_dir: preprocessing output directory, the manifest is written there
+			- hparams: audio hparams the features are extracted with
+			- feature_dirs: (wav_dir, mel_dir, linear_dir) the audio, mel and linear features are saved in
+		"""
+		self._path = os.path.join(out_dir, 'manifest.jsonl')
+		self._fingerprint = hparams_fingerprint(hparams)
+		self._feature_dirs = feature_dirs
+		#Features stored before this run, the ones of recorded utterances must still be there to be reused
+		self._readers = [feature_store.FeatureReader(directory) for directory in feature_dirs]
+		self._records = {}
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.removed_shards = 0
+		self.removed_bytes = 0
+
+		if os.path.isfile(self._path):
+			with open(self._path, encoding='utf-8') as f:
+				for line in f:
+					try:
+						record = json.loads(line)
+					except ValueError:
+						#Last line of a run that was killed mid-write
+						continue
+					self._records[record['key']] = record
+
+		self._file = open(self._path, 'a', encoding='utf-8')
+
+	def lookup(self, key, wav_path):
+		"""
+		Returns (True, features) if the utterance is up to date, (False, None) if it must be processed.
+		features is the (audio_filename, mel_filename, linear_filename, time_steps, mel_frames) part of
+		the train.txt row, or None if the utterance was dropped (e.g. longer than max_mel_frames).
+		"""
+		record = self._records.get(key)
+		if record is None or record['hparams'] != self._fingerprint:
+			return False, None
+
+		try:
+			stat = os.stat(wav_path)
+		except OSError:
+			return False, None
+		if stat.st_size != record['size']:
+			return False, None
+
+		#Features deleted since they were recorded are extracted again
+		features = record['features']
+		if features is not None and not all(filename in reader for reader, filename in zip(self._readers, features[:3])):
+			return False, None
+
+		#Only hash when the mtime moved (copied or touched files), a changed hash invalidates the record
+		if stat.st_mtime_ns != record['mtime']:
+			if file_hash(wav_path) != record['sha1']:
+				return False, None
+			record = dict(record, mtime=stat.st_mtime_ns)
+			self._append(record)
+
+		return True, (tuple(features) if features is not None else None)
+
+	def record(self, key, source, row):
+		"""
+		Marks the utterance as processed with the current audio hparams, source is the (size, mtime, sha1) of its wav
+		"""
+		size, mtime, sha1 = source
+		self._append({
+			'key': key,
+			'size': size,
+			'mtime': mtime,
+			'sha1': sha1,
+			'hparams': self._fingerprint,
+			'features': list(row[:5]) if row is not None else None,
+			})
+
+	def submit(self, executor, job, key, wav_path, text, speaker_num, lan_num):
+		"""
+		Submits job (a _process_utterance partial) to executor unless the manifest has its up to date output.
+
+		Returns a Future resolving to the train.txt row, like executor.submit(job)
+		"""
+		fresh, features = self.lookup(key, wav_path)
+		if fresh:
+			self.hits += 1
+			future = Future()
+			future.set_result(features + (text, speaker_num, lan_num) if features is not None else None)
+			return future
+
+		self.misses += 1
+		#The wav is hashed by the worker, the done callback (run by the executor's management thread) only records it
+		processed = executor.submit(_run_and_hash, job, wav_path)
+		future = Future()
+
+		def done(f):
+			if f.exception() is not None:
+				future.set_exception(f.exception())
+				return
+			row, source = f.result()
+			#Missing wavs are not recorded, they will be reported again on the next run
+			if source is not None:
+				self.record(key, source, row)
+			future.set_result(row)
+
+		processed.add_done_callback(done)
+		return future
+
+	def close(self):
+		"""
+		Compacts the manifest down to the latest record of each utterance and deletes the shards holding
+		no features of an up to date record (features of utterances extracted again, or no longer processed)
+		"""
+		with self._lock:
+			self._file.close()
+			tmp_path = self._path + '.tmp'
+			with open(tmp_path, 'w', encoding='utf-8') as f:
+				for record in self._records.values():
+					f.write(json.dumps(record) + '\n')
+			os.replace(tmp_path, self._path)
+
+			#Records of other audio hparams can never be reused, their features are not kept
+			features = [record['features'] for record in self._records.values()
+				if record['hparams'] == self._fingerprint and record['features'] is not None]
+			for i, directory in enumerate(self._feature_dirs):
+				removed, removed_bytes = feature_store.remove_unreferenced(directory, set(f[i] for f in features))
+				self.removed_shards += removed
+				self.removed_bytes += removed_bytes
+
+	def _append(self, record):
+		with self._lock:
+			self._records[record['key']] = record
+			self._file.write(json.dumps(record) + '\n')
+			self._file.flush()
+
+
+def submit_utterance(executor, manifest, job, key, wav_path, text, speaker_num, lan_num):
+	"""
+	executor.submit(job), skipping up to date utterances when a manifest is given
+	"""
+	if manifest is None:
+		return executor.submit(job)
+	return manifest.submit(executor, job, key, wav_path, text, speaker_num, lan_num)
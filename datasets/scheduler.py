@@ -0,0 +1,44 @@
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from datasets.manifest import submit_utterance
+
+#One unit of preprocessing work: job is the _process_utterance partial, the other fields identify the utterance
+Utterance = namedtuple('Utterance', ['job', 'key', 'wav_path', 'text', 'speaker_num', 'lan_num'])
+
+
+def run(utterances, n_jobs=12, manifest=None, max_in_flight=None):
+	"""
+	Processes utterances (of any number of datasets) through a single bounded worker pool
+
+	Utterances are consumed lazily and at most max_in_flight of them are submitted but not yet
+	yielded, so the pool stays busy across dataset boundaries while memory stays bounded.
+	Rows are yielded in submission order as soon as they are ready, which keeps train.txt
+	(and hence the Feeder train/test split) deterministic.
+
+	Args:
+		- utterances: iterable of Utterance
+		- n_jobs: Optional, number of worker process to parallelize across
+		- manifest: Optional, datasets.manifest.Manifest used to skip utterances that are already up to date
+		- max_in_flight: Optional, maximum number of pending utterances (defaults to 4 * n_jobs)
+
+	Returns:
+		- A generator of the train.txt rows (dropped utterances are skipped)
+	"""
+	max_in_flight = max_in_flight or 4 * n_jobs
+	pending = deque()
+
+	with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+		for utterance in utterances:
+			pending.append(submit_utterance(executor, manifest, *utterance))
+
+			#Backpressure: wait on the oldest submission once the window is full, and drain whatever is already done
+			while pending and (len(pending) >= max_in_flight or pending[0].done()):
+				row = pending.popleft().result()
+				if row is not None:
+					yield row
+
+		while pending:
+			row = pending.popleft().result()
+			if row is not None:
+				yield row
@@ -1,13 +1,13 @@
-from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 
 import numpy as np
 import os
 import re
-from datasets import audio
+from datasets import audio, feature_store, scheduler
+from datasets.scheduler import Utterance
 
 
-def build_from_path(hparams, speaker_num, lan_num, input_dir, prefix, mel_dir, linear_dir, wav_dir, n_jobs=12, tqdm=lambda x: x):
+def build_from_path(hparams, speaker_num, lan_num, input_dir, prefix, mel_dir, linear_dir, wav_dir, n_jobs=12, tqdm=lambda x: x, manifest=None):
   """
   Preprocesses the TH-CoSS dataset from a gven input path to given output directories
 
@@ -24,27 +24,31 @@ def build_from_path(hparams, speaker_num, lan_num, input_dir, prefix, mel_dir, l
     - wav_dir: output directory of the preprocessed speech audio dataset
     - n_jobs: Optional, number of worker process to parallelize across
     - tqdm: Optional, provides a nice progress bar
+    - manifest: Optional, datasets.manifest.Manifest used to skip utterances that are already up to date
 
   Returns:
     - A list of tuple describing the train examples. This should be written to train.txt
   """
 
-  # We use ProcessPoolExecutor to parallelize across processes, this is just for
-  # optimization purposes and it can be omited
-  executor = ProcessPoolExecutor(max_workers=n_jobs)
-  futures = []
+  # We use a single bounded ProcessPoolExecutor (see datasets/scheduler.py) to parallelize across processes,
+  # this is just for optimization purposes and it can be omited
+  return list(tqdm(scheduler.run(utterances(hparams, speaker_num, lan_num, input_dir, prefix, mel_dir, linear_dir, wav_dir), n_jobs, manifest)))
+
+def utterances(hparams, speaker_num, lan_num, input_dir, prefix, mel_dir, linear_dir, wav_dir):
+  """
+  Yields the scheduler.Utterance jobs of build_from_path, lazily so they can be chained with other datasets
+  """
   with open(os.path.join(input_dir, 'main.csv.txt'), 'r', encoding='utf-8') as f:
     for line in f:
       parts = line.strip().split('|')
       basename = prefix + parts[0]
       wav_path = os.path.join(input_dir, 'main', '{}.wav'.format(parts[0]))
       text = parts[2].replace('/','')
-      futures.append(executor.submit(partial(_process_utterance, mel_dir, linear_dir, wav_dir, basename, wav_path, text, speaker_num, lan_num, hparams)))
-
-  return [future.result() for future in tqdm(futures) if future.result() is not None]
+      yield Utterance(partial(_process_utterance, mel_dir, linear_dir, wav_dir, basename, wav_path, text, speaker_num, lan_num, hparams),
+        basename, wav_path, text, speaker_num, lan_num)
 
 
-def build_from_path_simple(hparams, speaker_num, lan_num, input_dir, mel_dir, linear_dir, wav_dir, n_jobs=12, tqdm=lambda x: x):
+def build_from_path_simple(hparams, speaker_num, lan_num, input_dir, mel_dir, linear_dir, wav_dir, n_jobs=12, tqdm=lambda x: x, manifest=None):
   """
   Preprocesses the TH-CoSS dataset from a gven input path to given output directories
 
@@ -61,24 +65,28 @@ def build_from_path_simple(hparams, speaker_num, lan_num, input_dir, mel_dir, li
     - wav_dir: output directory of the preprocessed speech audio dataset
     - n_jobs: Optional, number of worker process to parallelize across
     - tqdm: Optional, provides a nice progress bar
+    - manifest: Optional, datasets.manifest.Manifest used to skip utterances that are already up to date
 
   Returns:
     - A list of tuple describing the train examples. This should be written to train.txt
   """
 
-  # We use ProcessPoolExecutor to parallelize across processes, this is just for
-  # optimization purposes and it can be omited
-  executor = ProcessPoolExecutor(max_workers=n_jobs)
-  futures = []
+  # We use a single bounded ProcessPoolExecutor (see datasets/scheduler.py) to parallelize across processes,
+  # this is just for optimization purposes and it can be omited
+  return list(tqdm(scheduler.run(utterances_simple(hparams, speaker_num, lan_num, input_dir, mel_dir, linear_dir, wav_dir), n_jobs, manifest)))
+
+def utterances_simple(hparams, speaker_num, lan_num, input_dir, mel_dir, linear_dir, wav_dir):
+  """
+  Yields the scheduler.Utterance jobs of build_from_path_simple, lazily so they can be chained with other datasets
+  """
   with open(os.path.join(input_dir, 'metadata.csv.txt'), 'r', encoding='utf-8') as f:
     for line in f:
       parts = line.strip().split('|')
       basename = parts[0]
       wav_path = os.path.join(input_dir, 'wave', '{}.wav'.format(parts[0]))
       text = parts[2].replace('/','')
-      futures.append(executor.submit(partial(_process_utterance, mel_dir, linear_dir, wav_dir, basename, wav_path, text, speaker_num, lan_num, hparams)))
-
-  return [future.result() for future in tqdm(futures) if future.result() is not None]
+      yield Utterance(partial(_process_utterance, mel_dir, linear_dir, wav_dir, basename, wav_path, text, speaker_num, lan_num, hparams),
+        basename, wav_path, text, speaker_num, lan_num)
 
 
 
@@ -212,13 +220,13 @@ def _process_utterance(mel_dir, linear_dir, wav_dir, index, wav_path, text, spea
     return None
   out, mel_spectrogram, linear_spectrogram, time_steps, mel_frames = ret
 
-  # Write the spectrogram and audio to disk
+  # Write the spectrogram and audio to disk (packed shards or .npy files, see datasets/feature_store.py)
   audio_filename = 'audio-{}.npy'.format(index)
   mel_filename = 'mel-{}.npy'.format(index)
   linear_filename = 'linear-{}.npy'.format(index)
-  np.save(os.path.join(wav_dir, audio_filename), out.astype(np.float32), allow_pickle=False)
-  np.save(os.path.join(mel_dir, mel_filename), mel_spectrogram.T, allow_pickle=False)
-  np.save(os.path.join(linear_dir, linear_filename), linear_spectrogram.T, allow_pickle=False)
+  feature_store.save(wav_dir, audio_filename, out.astype(np.float32), hparams)
+  feature_store.save(mel_dir, mel_filename, mel_spectrogram.T, hparams)
+  feature_store.save(linear_dir, linear_filename, linear_spectrogram.T, hparams)
 
   # Return a tuple describing this training example
   return (audio_filename, mel_filename, linear_filename, time_steps, mel_frames, text, speaker_num, lan_num)
@@ -69,6 +69,10 @@ hparams = tf.contrib.training.HParams(
 	clip_mels_length = True, #For cases of OOM (Not really recommended, only use if facing unsolvable OOM errors, also consider clipping your samples to smaller chunks)
 	max_mel_frames = 800,  #Only relevant when clip_mels_length = True, please only use after trying output_per_steps=3 and still getting OOM errors.
 
+	#Preprocessed features storage
+	use_feature_store = True, #Whether to pack audio/mel/linear arrays into large memory-mappable shards (datasets/feature_store.py) instead of one .npy file per utterance (GTA synthesis exports the ground truth it lists in map.txt to .npy files)
+	feature_shard_bytes = 1024 ** 3, #Maximum size of a single shard file (1GB). Each preprocessing worker writes its own shards.
+
 	# Use LWS (https://github.com/Jonathan-LeRoux/lws) for STFT and phase reconstruction
 	# It's preferred to set True to use with https://github.com/r9y9/wavenet_vocoder
 	# Does not work if n_ffit is not multiple of hop_size!!
@@ -238,14 +242,25 @@ hparams = tf.contrib.training.HParams(
 
 	#performance parameters
 	tacotron_swap_with_cpu = False, #Whether to use cpu as support to gpu for decoder computation (Not recommended: may cause major slowdowns! Only use when critical!)
+	tacotron_input_pipeline = 'queue', #Training input pipeline: 'queue' (batches built in a python thread and fed to a FIFOQueue) or 'dataset' (tf.data pipeline with parallel loading and prefetch)
+	tacotron_data_workers = 0, #Number of worker processes loading the training groups of the 'queue' input pipeline (0 loads them in the feeder thread)
+	tacotron_mmap_targets = True, #Memory-map preprocessed .npy targets instead of reading them into memory (sharded targets are always memory-mapped)
+	tacotron_cache_bytes = 0, #Memory budget (in bytes) of the in-process cache of loaded training examples, least recently used examples are evicted first (0 disables the cache)
+	tacotron_data_parallel_calls = 8, #Number of examples loaded in parallel by the 'dataset' input pipeline
+	tacotron_data_bucket_width = 50, #Mel frames covered by each length bucket of the 'dataset' input pipeline (batches are made of examples of the same bucket)
+	tacotron_data_prefetch = 8, #Number of batches prepared ahead of the model by the 'dataset' input pipeline
 
 	#train/test split ratios, mini-batches sizes
 	tacotron_batch_size = 30, #number of training samples on each training steps
+	tacotron_batch_frames = None, #If set, training batches hold as many examples as fit in this many padded mel frames (batch size * longest target, over all GPUs) instead of tacotron_batch_size examples. Evaluation batches keep tacotron_batch_size.
+	tacotron_accumulation_steps = 1, #Number of batches whose gradients are averaged before each optimizer update (effective batch = tacotron_accumulation_steps batches, global_step counts updates). Lets a large effective batch train with the memory of a small tacotron_batch_size.
 	#Tacotron Batch synthesis supports ~16x the training batch size (no gradients during testing). 
 	#Training Tacotron with unmasked paddings makes it aware of them, which makes synthesis times different from training. We thus recommend masking the encoder.
 	tacotron_synthesis_batch_size = 1, #DO NOT MAKE THIS BIGGER THAN 1 IF YOU DIDN'T TRAIN TACOTRON WITH "mask_encoder=True"!!
+	tacotron_synthesis_linear = True, #Whether the synthesis graph predicts linear spectrograms (CBHG postnet, only when predict_linear). Disable when only mels are needed (e.g. for a neural vocoder) to build and run a smaller graph.
 	tacotron_test_size = 0.03, #% of data to keep as test data, if None, tacotron_test_batches must be not None. (5% is enough to have a good idea about overfit)
 	tacotron_test_batches = None, #number of test batches.
+	tacotron_test_cache_bytes = 512 * 1024 ** 2, #Memory budget (in bytes) of the padded test batches kept between evaluations, the other test batches are loaded and padded again each time
 
 	#Learning rate schedule
 	tacotron_decay_learning_rate = True, #boolean, determines if the learning rate will follow an exponential decay
@@ -266,6 +281,7 @@ hparams = tf.contrib.training.HParams(
 	tacotron_zoneout_rate = 0.1, #zoneout rate for all LSTM cells in the network
 	tacotron_dropout_rate = 0.5, #dropout rate for all convolutional layers + prenet
 	tacotron_clip_gradients = True, #whether to clip gradients
+	tacotron_gradient_fusion_bytes = 0, #If > 0 (e.g. 4 * 1024 ** 2), gradients smaller than this many bytes are averaged across GPUs in flat fused buffers of up to this size (fewer, larger ops). 0 averages each gradient separately. No effect with a single GPU.
 
 	#Evaluation parameters
 	natural_eval = False, #Whether to use 100% natural eval (to evaluate Curriculum Learning performance) or with same teacher-forcing ratio as in training (just for overfit)
@@ -1,4 +1,5 @@
 import argparse
+import itertools
 import os
 from multiprocessing import cpu_count
 
@@ -8,20 +9,60 @@ from datasets import ljspeech
 from datasets import databaker
 from datasets import thcoss
 from datasets import Huawei
+from datasets import scheduler
+from datasets.manifest import Manifest
 
 def write_metadata(metadata, out_dir):
-	with open(os.path.join(out_dir, 'train.txt'), 'w', encoding='utf-8') as f:
+	"""
+	Writes train.txt from any iterable of rows (rows can be streamed as they are processed)
+	"""
+	count = mel_frames = timesteps = 0
+	max_text_len = max_mel_frames = max_timesteps = 0
+	#Write to a temporary file first so an interrupted run does not clobber the previous train.txt
+	tmp_path = os.path.join(out_dir, 'train.txt.tmp')
+	with open(tmp_path, 'w', encoding='utf-8') as f:
 		for m in metadata:
 			f.write('|'.join([str(x) for x in m]) + '\n')
-	mel_frames = sum([int(m[4]) for m in metadata])
-	timesteps = sum([int(m[3]) for m in metadata])
+			count += 1
+			mel_frames += int(m[4])
+			timesteps += int(m[3])
+			max_text_len = max(max_text_len, len(m[5]))
+			max_mel_frames = max(max_mel_frames, int(m[4]))
+			max_timesteps = max(max_timesteps, int(m[3]))
+	os.replace(tmp_path, os.path.join(out_dir, 'train.txt'))
+
 	sr = hparams.sample_rate
 	hours = timesteps / sr / 3600
 	print('Write {} utterances, {} mel frames, {} audio timesteps, ({:.2f} hours)'.format(
-		len(metadata), mel_frames, timesteps, hours))
-	print('Max input length (text chars): {}'.format(max(len(m[5]) for m in metadata)))
-	print('Max mel frames length: {}'.format(max(int(m[4]) for m in metadata)))
-	print('Max audio timesteps length: {}'.format(max(m[3] for m in metadata)))
+		count, mel_frames, timesteps, hours))
+	print('Max input length (text chars): {}'.format(max_text_len))
+	print('Max mel frames length: {}'.format(max_mel_frames))
+	print('Max audio timesteps length: {}'.format(max_timesteps))
+
+
+def _dataset(name, utterances):
+	tqdm.write('processing {}...'.format(name))
+	for utterance in utterances:
+		yield utterance
+
+def _all_utterances(base_dir, hparams, mel_dir, lin_dir, wav_dir):
+	"""
+	Lazily chains the utterances of every dataset processed in 'all' mode, (speaker_num, lan_num) are assigned here
+	"""
+	use_prosody = False
+	datasets = [
+		('LJSpeech-1.1', ljspeech.utterances(hparams, 0, 0, os.path.join(base_dir, 'LJSpeech-1.1'), mel_dir, lin_dir, wav_dir)),
+		('DataBaker', databaker.utterances_CN(hparams, 1, 1, os.path.join(base_dir, 'DataBaker'), use_prosody, mel_dir, lin_dir, wav_dir)),
+		('TTS.HUawei.zhcmn.F.Deng', Huawei.utterances_CN(hparams, 2, 1, os.path.join(base_dir, 'TTS.HUawei.zhcmn.F.Deng'), use_prosody, mel_dir, lin_dir, wav_dir)),
+		('TTS.Huawei.enus.F.XuYue', Huawei.utterances_EN(hparams, 3, 0, os.path.join(base_dir, 'TTS.Huawei.enus.F.XuYue'), mel_dir, lin_dir, wav_dir)),
+		('TTS.THCoSS.zhcmn.F.M 03FR00', thcoss.utterances(hparams, 4, 1, os.path.join(base_dir, 'TTS.THCoSS.zhcmn.F.M/TH-CoSS/data/03FR00'), 'a', mel_dir, lin_dir, wav_dir)),
+		('TTS.THCoSS.zhcmn.F.M 03MR00', thcoss.utterances(hparams, 5, 1, os.path.join(base_dir, 'TTS.THCoSS.zhcmn.F.M/TH-CoSS/data/03MR00'), 'b', mel_dir, lin_dir, wav_dir)),
+		('TTS.Pachira.zhcmn.enus.F.DB1/zh-cmn', thcoss.utterances_simple(hparams, 6, 1, os.path.join(base_dir, 'TTS.Pachira.zhcmn.enus.F.DB1/zh-cmn'), mel_dir, lin_dir, wav_dir)),
+		('TTS.DataBaker.enus.M.DB1', databaker.utterances_EN(hparams, 7, 0, os.path.join(base_dir, 'TTS.DataBaker.enus.M.DB1'), 'x', mel_dir, lin_dir, wav_dir)),
+		('TTS.DataBaker.enus.F.DB1', databaker.utterances_EN(hparams, 8, 0, os.path.join(base_dir, 'TTS.DataBaker.enus.F.DB1'), 'y', mel_dir, lin_dir, wav_dir)),
+		('TTS.DataBaker.enus.F.DB2', databaker.utterances_EN(hparams, 9, 0, os.path.join(base_dir, 'TTS.DataBaker.enus.F.DB2'), 'z', mel_dir, lin_dir, wav_dir)),
+		]
+	return itertools.chain.from_iterable(_dataset(name, utterances) for name, utterances in datasets)
 
 
 def main():
@@ -33,6 +74,11 @@ def main():
 	parser.add_argument('--dataset', default='all')
 	parser.add_argument('--output', default='training_data')
 	parser.add_argument('--n_jobs', type=int, default=cpu_count())
+	parser.add_argument('--overwrite', action='store_true',
+		help='Process every utterance again instead of skipping the ones recorded as up to date in <output>/manifest.jsonl '
+		'(the feature shards of the previous runs are deleted once the run completes)')
+	parser.add_argument('--max_in_flight', type=int, default=None,
+		help='Maximum number of utterances submitted to the worker pool but not yet written (defaults to 4 * n_jobs)')
 	args = parser.parse_args()
 
 	modified_hp = hparams.parse(args.hparams)
@@ -46,74 +92,38 @@ def main():
 	os.makedirs(mel_dir, exist_ok=True)
 	os.makedirs(wav_dir, exist_ok=True)
 	os.makedirs(lin_dir, exist_ok=True)
+
+	#Skip utterances whose wav and audio hparams did not change since they were last processed
+	if args.overwrite and os.path.isfile(os.path.join(out_dir, 'manifest.jsonl')):
+		os.remove(os.path.join(out_dir, 'manifest.jsonl'))
+	manifest = Manifest(out_dir, modified_hp, (wav_dir, mel_dir, lin_dir))
 	
 	# Process dataset
 	metadata = []
 	if args.dataset == 'all':
-		use_prosody = False
-
-		in_dir = os.path.join(args.base_dir, 'LJSpeech-1.1')
-		print('processing LJSpeech-1.1.../n')
-		metadata_1 = ljspeech.build_from_path(modified_hp, 0, 0, in_dir, mel_dir, lin_dir, wav_dir, args.n_jobs, tqdm=tqdm)
-
-		in_dir = os.path.join(args.base_dir, 'DataBaker')
-		print('processing DataBaker.../n')
-		metadata_2 = databaker.build_from_path_CN(modified_hp, 1, 1, in_dir, use_prosody, mel_dir, lin_dir, wav_dir, args.n_jobs,tqdm=tqdm)
-		
-		in_dir = os.path.join(args.base_dir, 'TTS.HUawei.zhcmn.F.Deng')
-		print('processing TTS.HUawei.zhcmn.F.Deng.../n')
-		metadata_3 = Huawei.build_from_path_CN(modified_hp, 2, 1, in_dir, use_prosody, mel_dir, lin_dir, wav_dir, args.n_jobs, tqdm=tqdm)
-
-		in_dir = os.path.join(args.base_dir, 'TTS.Huawei.enus.F.XuYue')
-		print('processing TTS.Huawei.enus.F.XuYue.../n')
-		metadata_4 = Huawei.build_from_path_EN(modified_hp, 3, 0, in_dir, mel_dir, lin_dir, wav_dir, args.n_jobs, tqdm=tqdm)
-		
-		in_dir = os.path.join(args.base_dir, 'TTS.THCoSS.zhcmn.F.M/TH-CoSS/data/03FR00')
-		print('processing TTS.THCoSS.zhcmn.F.M 03FR00.../n')
-		metadata_5 = thcoss.build_from_path(modified_hp, 4, 1, in_dir, 'a', mel_dir, lin_dir, wav_dir, args.n_jobs,
-										  tqdm=tqdm)
-
-		in_dir = os.path.join(args.base_dir, 'TTS.THCoSS.zhcmn.F.M/TH-CoSS/data/03MR00')
-		print('processing TTS.THCoSS.zhcmn.F.M 03MR00.../n')
-		metadata_6 = thcoss.build_from_path(modified_hp, 5, 1, in_dir, 'b',  mel_dir, lin_dir, wav_dir, args.n_jobs,
-											tqdm=tqdm)
-											 
-		in_dir = os.path.join(args.base_dir, 'TTS.Pachira.zhcmn.enus.F.DB1/zh-cmn')
-		print('processing TTS.Pachira.zhcmn.enus.F.DB1/zh-cmn.../n')
-		metadata_7 = thcoss.build_from_path_simple(modified_hp, 6, 1, in_dir,  mel_dir, lin_dir, wav_dir, args.n_jobs,
-											tqdm=tqdm)
-
-		in_dir = os.path.join(args.base_dir, 'TTS.DataBaker.enus.M.DB1')
-		print('processing TTS.DataBaker.enus.M.DB1.../n')
-		metadata_8 = databaker.build_from_path_EN(modified_hp, 7, 0, in_dir, 'x', mel_dir, lin_dir, wav_dir, args.n_jobs,
-												   tqdm=tqdm)
-
-		in_dir = os.path.join(args.base_dir, 'TTS.DataBaker.enus.F.DB1')
-		print('processing TTS.DataBaker.enus.F.DB1.../n')
-		metadata_9 = databaker.build_from_path_EN(modified_hp, 8, 0, in_dir, 'y', mel_dir, lin_dir, wav_dir, args.n_jobs,
-												   tqdm=tqdm)
-
-		in_dir = os.path.join(args.base_dir, 'TTS.DataBaker.enus.F.DB2')
-		print('processing TTS.DataBaker.enus.F.DB2.../n')
-		metadata_10 = databaker.build_from_path_EN(modified_hp, 9, 0, in_dir, 'z', mel_dir, lin_dir, wav_dir, args.n_jobs,
-												   tqdm=tqdm)
-
-		metadata = metadata_1 + metadata_2 + metadata_3 + metadata_4 + metadata_5 + metadata_6 + metadata_7 + metadata_8 + metadata_9 + metadata_10
+		#Utterances of every dataset go through one shared, bounded worker pool and rows are streamed to train.txt
+		metadata = tqdm(scheduler.run(_all_utterances(args.base_dir, modified_hp, mel_dir, lin_dir, wav_dir),
+			args.n_jobs, manifest, args.max_in_flight))
 
 	elif args.dataset == 'LJSpeech-1.1':
-		metadata = ljspeech.build_from_path(modified_hp, in_dir, mel_dir, lin_dir, wav_dir, args.n_jobs, tqdm=tqdm)
+		metadata = ljspeech.build_from_path(modified_hp, in_dir, mel_dir, lin_dir, wav_dir, args.n_jobs, tqdm=tqdm, manifest=manifest)
 	elif args.dataset == 'DataBaker':
 		use_prosody = False
-		metadata = databaker.build_from_path_CN(modified_hp, in_dir, use_prosody, mel_dir, lin_dir, wav_dir, args.n_jobs, tqdm=tqdm)
+		metadata = databaker.build_from_path_CN(modified_hp, in_dir, use_prosody, mel_dir, lin_dir, wav_dir, args.n_jobs, tqdm=tqdm, manifest=manifest)
 	elif args.dataset == 'THCoSS':
 		use_prosody = True
-		metadata = thcoss.build_from_path(modified_hp, in_dir, use_prosody, mel_dir, lin_dir, wav_dir, args.n_jobs, tqdm=tqdm)
+		metadata = thcoss.build_from_path(modified_hp, in_dir, use_prosody, mel_dir, lin_dir, wav_dir, args.n_jobs, tqdm=tqdm, manifest=manifest)
 	else:
 		raise ValueError('Unsupported dataset provided: {} '.format(args.dataset))
 	
 	# Write metadata to 'train.txt' for training
 	write_metadata(metadata, out_dir)
 
+	manifest.close()
+	print('Reused {} up to date utterances, processed {}'.format(manifest.hits, manifest.misses))
+	if manifest.removed_shards > 0:
+		print('Removed {} unreferenced feature shards ({:.1f} MB)'.format(manifest.removed_shards, manifest.removed_bytes / 2**20))
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+import multiprocessing
+import queue
+import traceback
+from types import SimpleNamespace
+
+from infolog import log
+
+
+def _wav_from_mel(hparams, mel, path):
+	from datasets import audio
+	audio.save_wav(audio.inv_mel_spectrogram(mel, hparams), path, sr=hparams.sample_rate)
+
+def _wav_from_linear(hparams, linear, path):
+	from datasets import audio
+	audio.save_wav(audio.inv_linear_spectrogram(linear, hparams), path, sr=hparams.sample_rate)
+
+def _plot_alignment(hparams, alignment, path, **kwargs):
+	from tacotron.utils import plot
+	plot.plot_alignment(alignment, path, **kwargs)
+
+def _plot_spectrogram(hparams, spectrogram, path, **kwargs):
+	from tacotron.utils import plot
+	plot.plot_spectrogram(spectrogram, path, **kwargs)
+
+_jobs = {
+	'wav_from_mel': _wav_from_mel,
+	'wav_from_linear': _wav_from_linear,
+	'plot_alignment': _plot_alignment,
+	'plot_spectrogram': _plot_spectrogram,
+}
+
+
+def _run(jobs, done, hparams):
+	while True:
+		job = jobs.get()
+		if job is None:
+			break
+		name, args, kwargs = job
+		try:
+			_jobs[name](hparams, *args, **kwargs)
+		except Exception:
+			traceback.print_exc()
+		with done.get_lock():
+			done.value += 1
+
+
+class ArtifactWriter:
+	"""
+		Writes training artifacts (Griffin-Lim wavs and plots) in a separate process so the training loop only pays for fetching the arrays.
+
+		Jobs go through a bounded queue: when the worker falls more than max_pending jobs behind, new jobs
+		are dropped (and counted) instead of stalling training. backlog is the number of jobs not written yet.
+	"""
+
+	def __init__(self, hparams, max_pending=16):
+		#Spawned rather than forked from a process running a tensorflow session
+		context = multiprocessing.get_context('spawn')
+		self._jobs = context.Queue(max_pending)
+		self._done = context.Value('l', 0)
+		self.submitted = 0
+		self.dropped = 0
+		self._process = context.Process(target=_run, name='artifact_writer',
+			args=(self._jobs, self._done, SimpleNamespace(**hparams.values())))
+		self._process.daemon = True
+		self._process.start()
+
+	@property
+	def backlog(self):
+		return self.submitted - self._done.value
+
+	def _submit(self, name, *args, **kwargs):
+		try:
+			self._jobs.put_nowait((name, args, kwargs))
+			self.submitted += 1
+		except queue.Full:
+			self.dropped += 1
+			log('Artifact writer is {} jobs behind, dropped {} ({} dropped so far)'.format(self.backlog, name, self.dropped))
+
+	def wav_from_mel(self, mel, path):
+		self._submit('wav_from_mel', mel, path)
+
+	def wav_from_linear(self, linear, path):
+		self._submit('wav_from_linear', linear, path)
+
+	def plot_alignment(self, alignment, path, **kwargs):
+		self._submit('plot_alignment', alignment, path, **kwargs)
+
+	def plot_spectrogram(self, spectrogram, path, **kwargs):
+		self._submit('plot_spectrogram', spectrogram, path, **kwargs)
+
+	def close(self):
+		"""Waits for the pending artifacts to be written and stops the worker
+		"""
+		if self._process.is_alive():
+			if self.backlog:
+				log('Waiting for {} pending training artifacts..'.format(self.backlog))
+			self._jobs.put(None)
+			self._process.join()
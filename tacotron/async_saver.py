@@ -0,0 +1,111 @@
+import queue
+import threading
+import time
+
+import tensorflow as tf
+from infolog import log
+
+
+class AsyncSaver:
+	"""
+		Checkpoint saver that writes from a background thread.
+
+		save() only reads the variables into host memory (one session run), the files are written by a
+		tf.train.Saver of a mirror graph holding variables of the same names, shapes and dtypes, so the
+		checkpoints are identical to the ones of a tf.train.Saver of the training graph and restore the same way.
+		The .meta written with each checkpoint is the training graph's, exported once by the first save().
+		At most one snapshot waits while another is written, save() blocks beyond that.
+	"""
+
+	def __init__(self, var_list, max_to_keep=5, saver_def=None):
+		"""
+		Args:
+			- var_list: variables of the training graph to save
+			- max_to_keep: number of checkpoints kept
+			- saver_def: SaverDef of the training graph's tf.train.Saver, recorded in the exported meta graph
+		"""
+		self._variables = list(var_list)
+		self._saver_def = saver_def
+		self._meta_graph = None
+		self._graph = tf.Graph()
+		with self._graph.as_default():
+			self._values = []
+			mirrors = []
+			for variable in self._variables:
+				with tf.name_scope('snapshot'):
+					value = tf.placeholder(variable.dtype.base_dtype, variable.shape)
+				#The variable initializer is the op assigning it the fed snapshot
+				mirrors.append(tf.Variable(value, name=variable.op.name, trainable=False))
+				self._values.append(value)
+			self._initializers = [mirror.initializer for mirror in mirrors]
+			self._saver = tf.train.Saver(mirrors, max_to_keep=max_to_keep)
+		self._session = tf.Session(graph=self._graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+
+		self._jobs = queue.Queue(1)
+		self._error = None
+		self._thread = threading.Thread(name='async_saver', target=self._run)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def save(self, sess, save_path, global_step, on_saved=None):
+		"""Snapshots the variables and queues their writing
+
+		Args:
+			- sess: session of the training graph
+			- save_path: checkpoint path prefix, the global step is appended to it
+			- global_step: global step tensor
+			- on_saved: optional function called with the checkpoint prefix once it is written
+
+		Returns:
+			- the prefix the checkpoint will be written to
+		"""
+		self._raise_error()
+		if self._meta_graph is None:
+			#The mirror graph is not the one to restore, the training graph is exported here (graphs are not thread safe)
+			self._meta_graph = tf.train.export_meta_graph(graph=sess.graph, saver_def=self._saver_def).SerializeToString()
+		start = time.time()
+		values, step = sess.run([self._variables, global_step])
+		prefix = '{}-{}'.format(save_path, step)
+		self._jobs.put((values, save_path, step, on_saved, time.time() - start))
+		return prefix
+
+	def wait(self):
+		"""Blocks until the queued checkpoints are written
+		"""
+		self._jobs.join()
+		self._raise_error()
+
+	def close(self):
+		"""Writes the queued checkpoints and stops the writing thread
+		"""
+		if self._thread.is_alive():
+			self._jobs.put(None)
+			self._thread.join()
+		self._session.close()
+		self._raise_error()
+
+	def _run(self):
+		while True:
+			job = self._jobs.get()
+			if job is None:
+				self._jobs.task_done()
+				break
+			values, save_path, step, on_saved, snapshot_time = job
+			try:
+				start = time.time()
+				self._session.run(self._initializers, feed_dict=dict(zip(self._values, values)))
+				prefix = self._saver.save(self._session, save_path, global_step=step, write_meta_graph=False)
+				with open(prefix + '.meta', 'wb') as f:
+					f.write(self._meta_graph)
+				if on_saved is not None:
+					on_saved(prefix)
+				log('\nSaved checkpoint {} ({:.3f} sec snapshot, {:.3f} sec write)'.format(prefix, snapshot_time, time.time() - start))
+			except Exception as e:
+				self._error = e
+			finally:
+				self._jobs.task_done()
+
+	def _raise_error(self):
+		if self._error is not None:
+			error, self._error = self._error, None
+			raise error
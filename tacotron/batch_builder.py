@@ -0,0 +1,94 @@
+import numpy as np
+
+
+class BatchBuilder:
+	"""
+		Assembles padded multi tower batches directly into preallocated arrays.
+
+		Each output array is carved at its final shape out of a flat buffer, filled with its pad value,
+		and examples are copied into their slices. Buffers come from a ring of ring_size sets and only grow,
+		so once the longest batches were seen no batch array is allocated anymore.
+
+		A batch must not be referenced anymore when ring_size more batches are built. session.run does not copy
+		suitably aligned fed arrays, the enqueued tensors share their memory: a fed batch is referenced while it waits
+		in a queue, while its enqueue is blocked and while the step that dequeued it runs. ring_size must thus be
+		at least the queue capacity + 3 (the batch being built included).
+	"""
+
+	def __init__(self, hparams, pad, target_pad, token_pad, ring_size=2):
+		self._num_gpus = hparams.tacotron_num_gpus
+		self._num_mels = hparams.num_mels
+		self._num_freq = hparams.num_freq
+		self._pad = pad
+		self._target_pad = target_pad
+		self._token_pad = token_pad
+		self._ring = [{} for _ in range(ring_size)]
+		self._next = 0
+
+	def build(self, batches, outputs_per_step):
+		"""
+		Args:
+			- batches: list of examples (input, speaker_label, language_label, mel_target, token_target, linear_target, mel_length),
+				split in tacotron_num_gpus consecutive towers
+			- outputs_per_step: targets of each tower are padded to a multiple of it
+
+		Returns:
+			- (inputs, speaker_labels, language_labels, input_lengths, mel_targets, token_targets, linear_targets, targets_lengths, split_infos)
+				with the towers concatenated along the time axis
+		"""
+		assert 0 == len(batches) % self._num_gpus
+		size_per_device = len(batches) // self._num_gpus
+		towers = [batches[size_per_device*i: size_per_device*(i+1)] for i in range(self._num_gpus)]
+
+		#[input_max_len, mel_target_max_len, token_target_max_len, linear_target_max_len] of each tower
+		split_infos = np.asarray([[
+			max(len(x[0]) for x in tower),
+			_round_up(max(len(x[3]) for x in tower), outputs_per_step),
+			#Token targets get at least one 1 to mark the end of the sequence
+			_round_up(max(len(x[4]) for x in tower) + 1, outputs_per_step),
+			_round_up(max(len(x[5]) for x in tower), outputs_per_step) if batches[0][5] is not None else 0,
+			] for tower in towers], dtype=np.int32)
+		widths = split_infos.sum(axis=0)
+
+		buffers = self._ring[self._next]
+		self._next = (self._next + 1) % len(self._ring)
+		inputs = self._array(buffers, 'inputs', (size_per_device, widths[0]), np.int32, self._pad)
+		mel_targets = self._array(buffers, 'mel_targets', (size_per_device, widths[1], self._num_mels), np.float32, self._target_pad)
+		token_targets = self._array(buffers, 'token_targets', (size_per_device, widths[2]), np.float32, self._token_pad)
+		#Examples loaded without linear targets give linear_targets=None (and a 0 linear_target_max_len)
+		linear_targets = None
+		if batches[0][5] is not None:
+			linear_targets = self._array(buffers, 'linear_targets', (size_per_device, widths[3], self._num_freq), np.float32, self._target_pad)
+
+		input_offset = mel_offset = token_offset = linear_offset = 0
+		for tower, (input_len, mel_len, token_len, linear_len) in zip(towers, split_infos):
+			for j, x in enumerate(tower):
+				inputs[j, input_offset:input_offset + len(x[0])] = x[0]
+				mel_targets[j, mel_offset:mel_offset + len(x[3])] = x[3]
+				token_targets[j, token_offset:token_offset + len(x[4])] = x[4]
+				if linear_targets is not None:
+					linear_targets[j, linear_offset:linear_offset + len(x[5])] = x[5]
+			input_offset += input_len
+			mel_offset += mel_len
+			token_offset += token_len
+			linear_offset += linear_len
+
+		speaker_labels = np.asarray([x[1] for x in batches], dtype=np.int32)
+		language_labels = np.asarray([x[2] for x in batches], dtype=np.int32)
+		input_lengths = np.asarray([len(x[0]) for x in batches], dtype=np.int32)
+		targets_lengths = np.asarray([x[-1] for x in batches], dtype=np.int32) #Used to mask loss
+		return (inputs, speaker_labels, language_labels, input_lengths, mel_targets, token_targets, linear_targets, targets_lengths, split_infos)
+
+	def _array(self, buffers, name, shape, dtype, fill):
+		size = int(np.prod(shape))
+		flat = buffers.get(name)
+		if flat is None or flat.size < size:
+			flat = buffers[name] = np.empty(size, dtype=dtype)
+		array = flat[:size].reshape(shape)
+		array.fill(fill)
+		return array
+
+
+def _round_up(x, multiple):
+	remainder = x % multiple
+	return x if remainder == 0 else x + multiple - remainder
@@ -0,0 +1,278 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+from infolog import log
+from tacotron.feeder import Feeder
+
+
+class DatasetFeeder(Feeder):
+	"""
+		Feeds batches through a tf.data pipeline instead of the FIFOQueue/feed_dict background thread.
+
+		Examples are read by graph ops, bucketed by output length, padded per tower and prefetched. Targets are
+		read as byte ranges of their shard (or .npy file) and decoded in parallel, out of the GIL; token ids,
+		labels and target locations are looked up in per dataset tables, fed to placeholders when the iterators are
+		initialized so they never become graph constants. Targets not stored as float32
+		fall back to loading through tf.py_func, which the GIL serializes. Batches are split evenly across towers.
+		It exposes the same tensors (inputs, ..., split_infos and their eval_ counterparts) as Feeder.
+	"""
+
+	def _build_inputs(self, hparams):
+		#tf.data buffers have no size op, and load latencies are only measured when examples are loaded through tf.py_func
+		self.queue_size = None
+		with tf.device('/cpu:0'):
+			train_dataset, self._train_tables = self._make_dataset(self._train_meta, 'train', training=True)
+			self._train_iterator = train_dataset.make_initializable_iterator()
+			self.inputs, self.speaker_labels, self.language_labels, self.input_lengths, self.mel_targets, self.token_targets, \
+				self.linear_targets, self.targets_lengths, self.split_infos = self._restore_fields(self._train_iterator.get_next())
+
+			#Same batches as make_test_batches, the test rows are read in their order
+			test_batches, _ = self.make_test_batches()
+			test_rows = np.concatenate(test_batches) if test_batches else self._test_meta
+			eval_dataset, self._eval_tables = self._make_dataset(test_rows, 'eval', training=False)
+			self._eval_iterator = eval_dataset.make_initializable_iterator()
+			self.eval_inputs, self.eval_speaker_labels, self.eval_language_labels, self.eval_input_lengths, self.eval_mel_targets, self.eval_token_targets, \
+				self.eval_linear_targets, self.eval_targets_lengths, self.eval_split_infos = self._restore_fields(self._eval_iterator.get_next())
+
+	def _restore_fields(self, batch):
+		"""Puts the linear targets (last field of the dataset elements, when they are loaded) back at their Feeder position,
+		None when they are not loaded
+		"""
+		inputs, speaker_labels, language_labels, input_lengths, mel_targets, token_targets, targets_lengths, split_infos = batch[:8]
+		linear_targets = batch[8] if self._use_linear else None
+		return (inputs, speaker_labels, language_labels, input_lengths, mel_targets, token_targets, linear_targets, targets_lengths, split_infos)
+
+	def start_threads(self, session):
+		self._session = session
+		session.run([self._train_iterator.initializer, self._eval_iterator.initializer], feed_dict=dict(self._train_tables, **self._eval_tables))
+		log('\nStarted tf.data input pipeline ({} train, {} test examples)'.format(len(self._train_meta), len(self._test_meta)))
+
+	def mark_consumed(self, run_start):
+		pass
+
+	def take_dequeue_wait(self):
+		#Batches are prefetched in graph, the host never sees when they become ready
+		return None
+
+	def sampler_state(self):
+		#The tf.data pipeline shuffles in graph, its position is not saved
+		return None
+
+	def save_sampler_state(self, checkpoint_prefix, state=None):
+		pass
+
+	def restore_sampler_state(self, checkpoint_prefix):
+		log('The tf.data input pipeline does not resume its position, starting from a new epoch order')
+
+	def _make_dataset(self, rows, name, training):
+		"""Builds the dataset of the examples of rows
+
+		Returns:
+			- the dataset
+			- the feed_dict of its table placeholders, to feed when its iterator is initialized
+		"""
+		hp = self._hparams
+		num_gpus = hp.tacotron_num_gpus
+		assert 0 == hp.tacotron_batch_size % num_gpus
+
+		#Examples are referred to by their position in rows
+		dataset = tf.data.Dataset.range(len(rows))
+		if training:
+			dataset = dataset.shuffle(len(rows), reshuffle_each_iteration=True)
+		#Evaluation cycles through the test batches forever, like the eval queue
+		dataset = dataset.repeat()
+
+		start = time.time()
+		table = self._loader.locate_targets(rows)
+		if table is not None:
+			log('Located the targets of {} examples in {:.3f} sec'.format(len(rows), time.time() - start))
+			dataset, tables = self._read_examples(dataset, rows, table, name)
+		else:
+			log('Targets are not stored as float32, examples are loaded through tf.py_func (serialized by the GIL)')
+			dataset, tables = self._load_examples(dataset, rows), {}
+
+		#Examples are (input, speaker_label, language_label, input_length, mel_target, token_target, mel_length), followed by
+		#linear_target only when linear targets are used
+		padded_shapes = ([None], [], [], [], [None, hp.num_mels], [None], [])
+		padding_values = (
+			tf.constant(self._pad, tf.int32), tf.constant(0, tf.int32), tf.constant(0, tf.int32), tf.constant(0, tf.int32),
+			tf.constant(self._target_pad, tf.float32), tf.constant(self._token_pad, tf.float32), tf.constant(0, tf.int32))
+		if self._use_linear:
+			padded_shapes += ([None, hp.num_freq], )
+			padding_values += (tf.constant(self._target_pad, tf.float32), )
+
+		if training:
+			# Bucket examples based on similar output sequence length for efficiency
+			dataset = dataset.apply(tf.contrib.data.group_by_window(
+				key_func=lambda *example: tf.cast(example[6] // hp.tacotron_data_bucket_width, tf.int64),
+				reduce_func=lambda key, window: window.padded_batch(self._bucket_batch_size(key), padded_shapes, padding_values),
+				window_size_func=self._bucket_batch_size))
+		else:
+			#Test rows are already grouped in batches of similar length
+			dataset = dataset.padded_batch(hp.tacotron_batch_size, padded_shapes, padding_values)
+
+		dataset = dataset.map(self._pad_targets)
+		#Each tower is then concatenated along the time axis as split_infos describes
+		dataset = dataset.map(self._merge_towers)
+		return dataset.prefetch(hp.tacotron_data_prefetch), tables
+
+	def _read_examples(self, dataset, rows, table, name):
+		"""Maps positions in rows to examples with graph ops only
+
+		Returns:
+			- the dataset of examples
+			- the feed_dict of the placeholders of its tables (token ids, labels and target locations of rows only)
+		"""
+		hp = self._hparams
+		ids, offsets = self._loader.token_ids.packed()
+		#Token ids of rows, packed in row order
+		lengths = offsets[rows + 1] - offsets[rows]
+		token_end = np.cumsum(lengths)
+		token_start = token_end - lengths
+		values = dict(table,
+			token_ids=ids[np.arange(token_end[-1] if len(rows) else 0) + np.repeat(offsets[rows] - token_start, lengths)],
+			token_start=token_start, token_end=token_end,
+			speakers=self._metadata.speakers[rows], languages=self._metadata.languages[rows])
+
+		tables, feed_dict = {}, {}
+		for key, value in values.items():
+			if value.dtype.kind == 'U':
+				value = np.char.encode(value, 'utf-8')
+			dtype = tf.string if value.dtype.kind == 'S' else tf.as_dtype(value.dtype)
+			tables[key] = tf.placeholder(dtype, [None], name='{}_{}'.format(name, key))
+			feed_dict[tables[key]] = value
+
+		token_ids, token_start, token_end = tables['token_ids'], tables['token_start'], tables['token_end']
+		speakers, languages, frames = tables['speakers'], tables['languages'], tables['frames']
+		targets = [('mel', hp.num_mels)] + ([('linear', hp.num_freq)] if self._use_linear else [])
+		paths = {name: tables[name + '_path'] for name, _ in targets}
+		byte_offsets = {name: tables[name + '_offset'] for name, _ in targets}
+		fortran = {name: tables[name + '_fortran'] for name, _ in targets}
+
+		def read(index):
+			#One record of the target's bytes, at its offset in its file
+			records = [tf.data.FixedLengthRecordDataset(tf.gather(paths[name], index),
+				record_bytes=tf.cast(tf.gather(frames, index), tf.int64) * channels * 4, header_bytes=tf.gather(byte_offsets[name], index)).take(1)
+				for name, channels in targets]
+			return tf.data.Dataset.zip(tuple([tf.data.Dataset.from_tensors(index)] + records))
+
+		def decode(index, mel_record, linear_record=None):
+			length = tf.gather(frames, index)
+			input_data = token_ids[tf.gather(token_start, index):tf.gather(token_end, index)]
+			mel_target = self._decode_target(mel_record, length, hp.num_mels, tf.gather(fortran['mel'], index))
+			linear_target = None
+			if linear_record is not None:
+				linear_target = self._decode_target(linear_record, length, hp.num_freq, tf.gather(fortran['linear'], index))
+			#Create parallel sequences containing zeros to represent a non finished sequence
+			token_target = tf.zeros([length - 1], tf.float32)
+			return self._set_example_shapes(input_data, tf.gather(speakers, index), tf.gather(languages, index), tf.size(input_data),
+				mel_target, token_target, length, linear_target)
+
+		#Reads of different examples overlap, decoding runs in parallel map calls
+		dataset = dataset.apply(tf.contrib.data.parallel_interleave(read, cycle_length=hp.tacotron_data_parallel_calls))
+		return dataset.map(decode, num_parallel_calls=hp.tacotron_data_parallel_calls), feed_dict
+
+	def _decode_target(self, record, length, channels, fortran_order):
+		values = tf.decode_raw(record, tf.float32)
+		#Targets saved as transposed arrays are stored column major in their .npy file
+		return tf.cond(fortran_order,
+			lambda: tf.transpose(tf.reshape(values, [channels, length])),
+			lambda: tf.reshape(values, [length, channels]))
+
+	def _load_examples(self, dataset, rows):
+		"""Maps positions in rows to examples loaded in python (tf.py_func)
+		"""
+		hp = self._hparams
+
+		def load(index):
+			input_data, speaker_label, language_label, mel_target, token_target, linear_target, mel_length = self._load_example(rows[index])
+			example = (input_data, speaker_label, language_label, np.int32(len(input_data)), mel_target.astype(np.float32, copy=False),
+				token_target.astype(np.float32), np.int32(mel_length))
+			if linear_target is not None:
+				example += (linear_target.astype(np.float32, copy=False), )
+			return example
+
+		dtypes = [tf.int32, tf.int32, tf.int32, tf.int32, tf.float32, tf.float32, tf.int32] + ([tf.float32] if self._use_linear else [])
+		return dataset.map(lambda index: self._set_example_shapes(*tf.py_func(load, [index], dtypes, stateful=False)),
+			num_parallel_calls=hp.tacotron_data_parallel_calls)
+
+	def _bucket_batch_size(self, key):
+		"""Number of examples in the batches of a length bucket: tacotron_batch_size, or as many as fit in tacotron_batch_frames
+		padded frames (a multiple of tacotron_num_gpus, at least one example per tower)
+		"""
+		hp = self._hparams
+		if hp.tacotron_batch_frames is None:
+			return tf.constant(hp.tacotron_batch_size, tf.int64)
+		num_gpus = hp.tacotron_num_gpus
+		#Upper bound of the bucket's padded target length
+		max_frames = (key + 1) * hp.tacotron_data_bucket_width
+		max_frames = (max_frames + hp.outputs_per_step - 1) // hp.outputs_per_step * hp.outputs_per_step
+		return tf.maximum(hp.tacotron_batch_frames // max_frames // num_gpus * num_gpus, num_gpus)
+
+	def _set_example_shapes(self, input_data, speaker_label, language_label, input_length, mel_target, token_target, mel_length, linear_target=None):
+		input_data.set_shape([None])
+		speaker_label.set_shape([])
+		language_label.set_shape([])
+		input_length.set_shape([])
+		mel_target.set_shape([None, self._hparams.num_mels])
+		token_target.set_shape([None])
+		mel_length.set_shape([])
+		example = (input_data, speaker_label, language_label, input_length, mel_target, token_target, mel_length)
+		if linear_target is None:
+			return example
+		linear_target.set_shape([None, self._hparams.num_freq])
+		return example + (linear_target, )
+
+	def _pad_targets(self, inputs, speaker_labels, language_labels, input_lengths, mel_targets, token_targets, targets_lengths, linear_targets=None):
+		#Round the target length up to a multiple of outputs_per_step, tokens are padded with 1s to the same length
+		r = self._hparams.outputs_per_step
+		max_len = tf.shape(mel_targets)[1]
+		data_len = (max_len + r - 1) // r * r
+		mel_targets = tf.pad(mel_targets, [[0, 0], [0, data_len - max_len], [0, 0]], constant_values=self._target_pad)
+		token_targets = tf.pad(token_targets, [[0, 0], [0, data_len - tf.shape(token_targets)[1]]], constant_values=self._token_pad)
+		batch = (inputs, speaker_labels, language_labels, input_lengths, mel_targets, token_targets, targets_lengths)
+		if linear_targets is None:
+			return batch
+		linear_targets = tf.pad(linear_targets, [[0, 0], [0, data_len - max_len], [0, 0]], constant_values=self._target_pad)
+		return batch + (linear_targets, )
+
+	def _merge_towers(self, inputs, speaker_labels, language_labels, input_lengths, mel_targets, token_targets, targets_lengths, linear_targets=None):
+		num_gpus = self._hparams.tacotron_num_gpus
+		#[batch_size, ...] -> [num_gpus, size_per_device, ...], towers share the batch's padded lengths
+		inputs, mel_targets, token_targets = [self._split_towers(x) for x in (inputs, mel_targets, token_targets)]
+		#Like the queue feeder, split_infos has a 0 linear width when linear targets are not fed
+		linear_width = 0
+		if linear_targets is not None:
+			linear_targets = self._split_towers(linear_targets)
+			linear_width = tf.shape(linear_targets)[2]
+		split_infos = tf.tile([[tf.shape(inputs)[2], tf.shape(mel_targets)[2], tf.shape(token_targets)[2], linear_width]], [num_gpus, 1])
+
+		inputs = self._concat_towers(inputs)
+		mel_targets = self._concat_towers(mel_targets)
+		token_targets = self._concat_towers(token_targets)
+
+		inputs.set_shape([None, None])
+		speaker_labels.set_shape([None])
+		language_labels.set_shape([None])
+		input_lengths.set_shape([None])
+		mel_targets.set_shape([None, None, self._hparams.num_mels])
+		token_targets.set_shape([None, None])
+		targets_lengths.set_shape([None])
+		split_infos.set_shape([num_gpus, 4])
+		batch = (inputs, speaker_labels, language_labels, input_lengths, mel_targets, token_targets, targets_lengths, split_infos)
+		if linear_targets is None:
+			return batch
+		linear_targets = self._concat_towers(linear_targets)
+		linear_targets.set_shape([None, None, self._hparams.num_freq])
+		return batch + (linear_targets, )
+
+	def _split_towers(self, x):
+		#[batch_size, T, ...] -> [num_gpus, size_per_device, T, ...]
+		return tf.reshape(x, tf.concat([[self._hparams.tacotron_num_gpus, -1], tf.shape(x)[1:]], axis=0))
+
+	def _concat_towers(self, x):
+		#[num_gpus, size_per_device, T, ...] -> [size_per_device, num_gpus * T, ...]
+		shape = tf.shape(x)
+		x = tf.transpose(x, [1, 0] + list(range(2, x.shape.ndims)))
+		return tf.reshape(x, tf.concat([[shape[1], shape[0] * shape[2]], shape[3:]], axis=0))
@@ -1,15 +1,134 @@
+import glob
+import hashlib
+import json
 import os
 import threading
 import time
 import traceback
+from collections import deque
+from multiprocessing import Pool
 
 import numpy as np
 import tensorflow as tf
+from datasets.feature_store import FeatureReader
 from infolog import log
 from sklearn.model_selection import train_test_split
+from tacotron.batch_builder import BatchBuilder
+from tacotron.feeder_metrics import FeederMetrics
+from tacotron.metadata import MetadataIndex
+from tacotron.sampler import EpochSampler
+from tacotron.utils.cache import LRUCache
+from tacotron.utils.symbols import symbols
 from tacotron.utils.text import text_to_sequence
 
 _batches_per_group = 64
+#Capacities of the train and eval input queues
+_train_queue_capacity = 8
+_eval_queue_capacity = 1
+#Example loader of a loading worker process (set by _init_worker)
+_worker_loader = None
+
+
+def _init_worker(loader):
+	global _worker_loader
+	_worker_loader = loader
+
+def _load_in_worker(row):
+	start = time.time()
+	example = _worker_loader(row)
+	return example, time.time() - start
+
+
+class TokenIds:
+	"""
+		Token ids of every metadata text, packed in one int32 array: the ids of row i are ids[offsets[i]:offsets[i+1]].
+
+		Texts go through text_to_sequence once, the packed ids are saved next to the metadata file
+		and reused as long as the metadata file, cleaners and symbols are unchanged.
+	"""
+
+	def __init__(self, metadata, cleaner_names):
+		path = os.path.splitext(metadata.metadata_filename)[0] + '_tokens.npz'
+		signature = hashlib.sha1('{}|{}|{}'.format(metadata.signature, ','.join(cleaner_names), ''.join(symbols)).encode('utf-8')).hexdigest()
+
+		self._ids = self._offsets = None
+		if os.path.isfile(path):
+			with np.load(path) as data:
+				if str(data['signature']) == signature and len(data['offsets']) == len(metadata) + 1:
+					self._ids, self._offsets = data['ids'], data['offsets']
+
+		if self._ids is None:
+			start = time.time()
+			sequences = [text_to_sequence(metadata.text(row), cleaner_names) for row in range(len(metadata))]
+			self._offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+			np.cumsum([len(x) for x in sequences], out=self._offsets[1:])
+			self._ids = np.fromiter((i for x in sequences for i in x), dtype=np.int32, count=self._offsets[-1])
+			tmp_path = path + '.tmp.npz'
+			np.savez(tmp_path, ids=self._ids, offsets=self._offsets, signature=np.asarray(signature))
+			os.replace(tmp_path, path)
+			log('Converted {} texts to token ids in {:.3f} sec ({})'.format(len(metadata), time.time() - start, path))
+
+	def lookup(self, row):
+		return self._ids[self._offsets[row]:self._offsets[row + 1]]
+
+	def packed(self):
+		"""Returns the (ids, offsets) arrays"""
+		return self._ids, self._offsets
+
+
+class ExampleLoader:
+	"""
+		Loads the example (input, speaker_label, language_label, mel_target, token_target, linear_target, mel_length) of a metadata row.
+
+		Loaders are picklable so they can be handed to the loading worker processes.
+	"""
+
+	def __init__(self, metadata, mel_dir, linear_dir, token_ids, load_linear=True, mmap=False):
+		self._metadata = metadata
+		self._token_ids = token_ids
+		#Read targets from packed shards when preprocessing wrote them, per-utterance .npy files otherwise
+		#With mmap, .npy targets are memory-mapped so padding copies them straight from the page cache
+		self._mel_reader = FeatureReader(mel_dir, mmap=mmap)
+		#Linear targets are never read when the model does not use them (linear_target is None)
+		self._linear_reader = FeatureReader(linear_dir, mmap=mmap) if load_linear else None
+
+	def __call__(self, row):
+		input_data = self._token_ids.lookup(row)
+		mel_target = self._mel_reader.load(self._metadata.mel_filename(row))
+		#Create parallel sequences containing zeros to represent a non finished sequence
+		token_target = np.asarray([0.] * (len(mel_target) - 1))
+		linear_target = self._linear_reader.load(self._metadata.linear_filename(row)) if self._linear_reader is not None else None
+
+		speaker_label = np.asarray(self._metadata.speakers[row], dtype=np.int32)
+		language_label = np.asarray(self._metadata.languages[row], dtype=np.int32)
+		return (input_data, speaker_label, language_label, mel_target, token_target, linear_target, len(mel_target))
+
+	@property
+	def token_ids(self):
+		return self._token_ids
+
+	def locate_targets(self, rows):
+		"""Locates the raw bytes of the mel (and linear) targets of rows, for readers outside python
+
+		Returns:
+			- a dict of per row arrays: frames, mel_path, mel_offset, mel_fortran (and linear_* when linear targets are loaded),
+				or None when a target is not stored as little endian float32
+		"""
+		readers = [('mel', self._mel_reader, self._metadata.mel_filename)]
+		if self._linear_reader is not None:
+			readers.append(('linear', self._linear_reader, self._metadata.linear_filename))
+
+		table = {'frames': np.zeros(len(rows), dtype=np.int32)}
+		for name, reader, filename in readers:
+			locations = [reader.locate(filename(row)) for row in rows]
+			if any(dtype != np.dtype('<f4') for _, _, dtype, _, _ in locations):
+				return None
+			table[name + '_path'] = np.asarray([path for path, _, _, _, _ in locations])
+			table[name + '_offset'] = np.asarray([offset for _, offset, _, _, _ in locations], dtype=np.int64)
+			table[name + '_fortran'] = np.asarray([fortran for _, _, _, _, fortran in locations], dtype=np.bool_)
+			table['frames'][:] = [shape[0] for _, _, _, shape, _ in locations]
+		return table
+
 
 class Feeder:
 	"""
@@ -21,17 +140,26 @@ class Feeder:
 		self._coord = coordinator
 		self._hparams = hparams
 		self._cleaner_names = [x.strip() for x in hparams.cleaners.split(',')]
-		self._train_offset = 0
-		self._test_offset = 0
 
 		# Load metadata
 		self._mel_dir = os.path.join(os.path.dirname(metadata_filename), 'mels')
 		self._linear_dir = os.path.join(os.path.dirname(metadata_filename), 'linear')
-		with open(metadata_filename, encoding='utf-8') as f:
-			self._metadata = [line.strip().split('|') for line in f]
-			frame_shift_ms = hparams.hop_size / hparams.sample_rate
-			hours = sum([int(x[4]) for x in self._metadata]) * frame_shift_ms / (3600)
-			log('Loaded metadata for {} examples ({:.2f} hours)'.format(len(self._metadata), hours))
+		#Examples are referred to by their metadata row index
+		self._metadata = MetadataIndex(metadata_filename)
+		frame_shift_ms = hparams.hop_size / hparams.sample_rate
+		hours = self._metadata.mel_frames.sum(dtype=np.int64) * frame_shift_ms / (3600)
+		log('Loaded metadata for {} examples ({:.2f} hours)'.format(len(self._metadata), hours))
+
+		#The target set follows the model configuration: linear targets are only loaded and fed when they are predicted
+		self._use_linear = hparams.predict_linear
+		self._loader = ExampleLoader(self._metadata, self._mel_dir, self._linear_dir, TokenIds(self._metadata, self._cleaner_names),
+			load_linear=self._use_linear, mmap=hparams.tacotron_mmap_targets)
+		#Keep recently loaded training examples in memory, up to tacotron_cache_bytes (0 disables the cache)
+		self._cache = LRUCache(hparams.tacotron_cache_bytes)
+		#Padded test batches are kept up to tacotron_test_cache_bytes, the others are loaded and padded again on every pass
+		self._test_cache = LRUCache(hparams.tacotron_test_cache_bytes)
+		#Input pipeline measurements, written with the training summaries
+		self.metrics = FeederMetrics()
 
 		#Train test split
 		if hparams.tacotron_test_size is None:
@@ -49,11 +177,23 @@ class Feeder:
 		test_indices = test_indices[:len_test_indices]
 		train_indices = np.concatenate([train_indices, extra_test])
 
-		self._train_meta = list(np.array(self._metadata)[train_indices])
-		self._test_meta = list(np.array(self._metadata)[test_indices])
+		self._train_meta = train_indices
+		self._test_meta = test_indices
 
 		self.test_steps = len(self._test_meta) // hparams.tacotron_batch_size
 
+		#Training rows are drawn by a seeded sampler whose position is saved with the checkpoints.
+		#Planned groups are tracked as [sampler state at group start, number of batches, batches consumed]
+		#until the model consumed all their batches (the train loop reports them with mark_consumed)
+		self._sampler = EpochSampler(self._train_meta, hparams.tacotron_data_random_state)
+		self._groups = deque()
+		self._skip_batches = 0
+		self._progress_lock = threading.Lock()
+		#Host times train batches finished enqueueing and training runs started, paired in order to measure the dequeue wait
+		self._enqueue_times = deque()
+		self._run_starts = deque()
+		self._dequeue_wait = 0.
+
 		if hparams.tacotron_test_size is None:
 			assert hparams.tacotron_test_batches == self.test_steps
 
@@ -67,6 +207,24 @@ class Feeder:
 			self._target_pad = 0.
 		#Mark finished sequences with 1s
 		self._token_pad = 1.
+		#One builder per enqueueing thread. session.run does not copy aligned fed arrays, a batch holds its buffers while it
+		#waits in the queue, is blocked in enqueue and is trained on, so the rings hold one more set than that
+		self._train_builder = BatchBuilder(hparams, self._pad, self._target_pad, self._token_pad, ring_size=_train_queue_capacity + 3)
+		self._test_builder = BatchBuilder(hparams, self._pad, self._target_pad, self._token_pad, ring_size=_eval_queue_capacity + 3)
+
+		#Loading worker processes, created by _build_inputs when tacotron_data_workers > 0
+		self._pool = None
+		self._build_inputs(hparams)
+
+
+	def _build_inputs(self, hparams):
+		"""
+		Creates the train and eval input tensors (inputs, speaker_labels, ..., split_infos and their eval_ counterparts)
+		"""
+		#Load training groups in worker processes while the previous group is being enqueued (0 loads them in the feeder thread)
+		#The pool is forked here, before any session is created
+		if hparams.tacotron_data_workers > 0:
+			self._pool = Pool(hparams.tacotron_data_workers, initializer=_init_worker, initargs=(self._loader, ))
 
 		with tf.device('/cpu:0'):
 			# Create placeholders for inputs and targets. Don't specify batch size because we want
@@ -78,43 +236,127 @@ class Feeder:
 			tf.placeholder(tf.int32, shape=(None, ), name='input_lengths'),
 			tf.placeholder(tf.float32, shape=(None, None, hparams.num_mels), name='mel_targets'),
 			tf.placeholder(tf.float32, shape=(None, None), name='token_targets'),
-			tf.placeholder(tf.float32, shape=(None, None, hparams.num_freq), name='linear_targets'),
+			tf.placeholder(tf.float32, shape=(None, None, hparams.num_freq), name='linear_targets') if self._use_linear else None,
 			tf.placeholder(tf.int32, shape=(None, ), name='targets_lengths'),
 			tf.placeholder(tf.int32, shape=(hparams.tacotron_num_gpus, None), name='split_infos'),
 			]
+			#Only the targets used by the model are enqueued
+			fed_placeholders = [p for p in self._placeholders if p is not None]
 
 			# Create queue for buffering data
-			queue = tf.FIFOQueue(8, [tf.int32, tf.int32, tf.int32, tf.int32, tf.float32, tf.float32, tf.float32, tf.int32, tf.int32], name='input_queue')
-			self._enqueue_op = queue.enqueue(self._placeholders)
-			self.inputs, self.speaker_labels, self.language_labels, self.input_lengths, self.mel_targets, self.token_targets, self.linear_targets, self.targets_lengths, self.split_infos = queue.dequeue()
-
-			self.inputs.set_shape(self._placeholders[0].shape)
-			self.speaker_labels.set_shape(self._placeholders[1].shape)
-			self.language_labels.set_shape(self._placeholders[2].shape)
-			self.input_lengths.set_shape(self._placeholders[3].shape)
-			self.mel_targets.set_shape(self._placeholders[4].shape)
-			self.token_targets.set_shape(self._placeholders[5].shape)
-			self.linear_targets.set_shape(self._placeholders[6].shape)
-			self.targets_lengths.set_shape(self._placeholders[7].shape)
-			self.split_infos.set_shape(self._placeholders[8].shape)
+			queue = tf.FIFOQueue(_train_queue_capacity, [p.dtype for p in fed_placeholders], name='input_queue')
+			self._enqueue_op = queue.enqueue(fed_placeholders)
+			self.queue_size = queue.size()
+			self.inputs, self.speaker_labels, self.language_labels, self.input_lengths, self.mel_targets, self.token_targets, \
+				self.linear_targets, self.targets_lengths, self.split_infos = self._restore_fields(queue.dequeue())
 
 
 			# Create eval queue for buffering eval data
-			eval_queue = tf.FIFOQueue(1, [tf.int32, tf.int32, tf.int32, tf.int32, tf.float32, tf.float32, tf.float32, tf.int32, tf.int32], name='eval_queue')
-			self._eval_enqueue_op = eval_queue.enqueue(self._placeholders)
+			eval_queue = tf.FIFOQueue(_eval_queue_capacity, [p.dtype for p in fed_placeholders], name='eval_queue')
+			self._eval_enqueue_op = eval_queue.enqueue(fed_placeholders)
 			self.eval_inputs, self.eval_speaker_labels, self.eval_language_labels, self.eval_input_lengths, self.eval_mel_targets, self.eval_token_targets, \
-				self.eval_linear_targets, self.eval_targets_lengths, self.eval_split_infos = eval_queue.dequeue()
-
-			self.eval_inputs.set_shape(self._placeholders[0].shape)
-			self.eval_speaker_labels.set_shape(self._placeholders[1].shape)
-			self.eval_language_labels.set_shape(self._placeholders[2].shape)
-			self.eval_input_lengths.set_shape(self._placeholders[3].shape)
-			self.eval_mel_targets.set_shape(self._placeholders[4].shape)
-			self.eval_token_targets.set_shape(self._placeholders[5].shape)
-			self.eval_linear_targets.set_shape(self._placeholders[6].shape)
-			self.eval_targets_lengths.set_shape(self._placeholders[7].shape)
-			self.eval_split_infos.set_shape(self._placeholders[8].shape)
+				self.eval_linear_targets, self.eval_targets_lengths, self.eval_split_infos = self._restore_fields(eval_queue.dequeue())
 
+	def _restore_fields(self, dequeued):
+		"""Puts dequeued tensors back at their placeholder position (None for targets that are not fed), with the placeholder shapes
+		"""
+		dequeued = iter(dequeued)
+		fields = []
+		for placeholder in self._placeholders:
+			if placeholder is None:
+				fields.append(None)
+				continue
+			tensor = next(dequeued)
+			tensor.set_shape(placeholder.shape)
+			fields.append(tensor)
+		return fields
+
+	def _feed_dict(self, prepared):
+		return {placeholder: value for placeholder, value in zip(self._placeholders, prepared) if placeholder is not None}
+
+	def mark_consumed(self, run_start):
+		"""Reports a training batch consumed by the model, call after each session run that dequeued one
+
+		Args:
+			- run_start: host time the run started, the run waited on the input pipeline if its batch was enqueued later
+		"""
+		with self._progress_lock:
+			if self._groups:
+				self._groups[0][2] += 1
+				if self._groups[0][2] >= self._groups[0][1]:
+					self._groups.popleft()
+			self._run_starts.append(run_start)
+			self._pair_dequeues()
+
+	def take_dequeue_wait(self):
+		"""Returns the seconds training runs waited on the input pipeline since the last call
+
+		A run's wait is only known once its batch finished enqueueing on the host, it may be counted on the next call.
+		"""
+		with self._progress_lock:
+			wait, self._dequeue_wait = self._dequeue_wait, 0.
+		return wait
+
+	def _enqueued(self):
+		#Runs once per training batch enqueued
+		with self._progress_lock:
+			self._enqueue_times.append(time.time())
+			self._pair_dequeues()
+
+	def _pair_dequeues(self):
+		#Batches are dequeued in enqueue order
+		while self._enqueue_times and self._run_starts:
+			self._dequeue_wait += max(0., self._enqueue_times.popleft() - self._run_starts.popleft())
+
+	def sampler_state(self):
+		"""Returns the current position of the training sampler
+
+		The position is the start of the group of the next batch to consume plus the number of batches
+		of that group already consumed, batches that are prepared or queued but not consumed yet are not counted.
+		"""
+		with self._progress_lock:
+			if self._groups:
+				state, _, consumed = self._groups[0]
+			else:
+				state, consumed = self._sampler.state(), 0
+		return dict(state, consumed_batches=consumed)
+
+	def save_sampler_state(self, checkpoint_prefix, state=None):
+		"""Writes the position of the training sampler next to a checkpoint (<checkpoint_prefix>.sampler.json)
+
+		Args:
+			- checkpoint_prefix: path prefix of the saved checkpoint
+			- state: position taken by sampler_state() when the checkpoint variables were read, defaults to the current one
+		"""
+		if state is None:
+			state = self.sampler_state()
+		path = checkpoint_prefix + '.sampler.json'
+		with open(path + '.tmp', 'w') as f:
+			json.dump(state, f)
+		os.replace(path + '.tmp', path)
+
+		#Drop the states of the checkpoints the saver removed (max_to_keep)
+		for state_path in glob.glob(os.path.join(os.path.dirname(checkpoint_prefix), '*.sampler.json')):
+			if not os.path.exists(state_path[:-len('.sampler.json')] + '.index'):
+				os.remove(state_path)
+
+	def restore_sampler_state(self, checkpoint_prefix):
+		"""Resumes the training sampler at the position saved with a checkpoint, call before start_threads
+		"""
+		path = checkpoint_prefix + '.sampler.json'
+		if not os.path.isfile(path):
+			log('No sampler state at {}, starting from a new epoch order'.format(path))
+			return
+		with open(path) as f:
+			state = json.load(f)
+		try:
+			self._sampler.restore(state)
+		except ValueError as e:
+			log('Cannot restore sampler state: {}, starting from a new epoch order'.format(e))
+			return
+		#The interrupted group is planned again identically, its dequeued batches are skipped without being loaded
+		self._skip_batches = state['consumed_batches']
+		log('Resuming training data at epoch {}, example {} (+{} batches)'.format(state['epoch'], state['offset'], state['consumed_batches']))
 
 	def start_threads(self, session):
 		self._session = session
@@ -126,145 +368,188 @@ class Feeder:
 		thread.daemon = True #Thread will close when parent quits
 		thread.start()
 
-	def _get_test_groups(self):
-		meta = self._test_meta[self._test_offset]
-		self._test_offset += 1
-
-		text = meta[5]
-
-		input_data = np.asarray(text_to_sequence(text, self._cleaner_names), dtype=np.int32)
-		mel_target = np.load(os.path.join(self._mel_dir, meta[1]))
-		#Create parallel sequences containing zeros to represent a non finished sequence
-		token_target = np.asarray([0.] * (len(mel_target) - 1))
-		linear_target = np.load(os.path.join(self._linear_dir, meta[2]))
-
-		speaker_label = np.asarray(int(meta[6]), dtype=np.int32)
-		language_label = np.asarray(int(meta[7]), dtype=np.int32)
-		return (input_data, speaker_label, language_label, mel_target, token_target, linear_target, len(mel_target))
+	def close(self):
+		"""Terminates the loading worker processes, called when training stops (the train thread does it as well when it exits)
+		"""
+		pool, self._pool = self._pool, None
+		if pool is not None:
+			pool.terminate()
+			pool.join()
 
 	def make_test_batches(self):
-		start = time.time()
+		"""Splits the test rows in batches of tacotron_batch_size rows of similar output length, from the metadata lengths
 
-		# Read a group of examples
+		Nothing is loaded here, test examples are read batch by batch when the batch is enqueued.
+		"""
 		n = self._hparams.tacotron_batch_size
 		r = self._hparams.outputs_per_step
 
 		#Test on entire test set
-		examples = [self._get_test_groups() for i in range(len(self._test_meta))]
-
 		# Bucket examples based on similar output sequence length for efficiency
-		examples.sort(key=lambda x: x[-1])
-		batches = [examples[i: i+n] for i in range(0, len(examples), n)]
+		rows = self._test_meta[np.argsort(self._metadata.mel_frames[self._test_meta], kind='stable')]
+		batches = [rows[i: i+n] for i in range(0, len(rows), n)]
 		np.random.shuffle(batches)
 
-		log('\nGenerated {} test batches of size {} in {:.3f} sec'.format(len(batches), n, time.time() - start))
+		log('\nPlanned {} test batches of size {}'.format(len(batches), n))
 		return batches, r
 
 	def _enqueue_next_train_group(self):
+		n = self._hparams.tacotron_batch_size
+		r = self._hparams.outputs_per_step
+		try:
+			self._enqueue_train_groups(n, r)
+		finally:
+			self.close()
+
+	def _enqueue_train_groups(self, n, r):
+		pending = self._load_train_group(self._plan_train_group())
+
 		while not self._coord.should_stop():
 			start = time.time()
 
 			# Read a group of examples
-			n = self._hparams.tacotron_batch_size
-			r = self._hparams.outputs_per_step
-			examples = [self._get_next_example() for i in range(n * _batches_per_group)]
-			# Bucket examples based on similar output sequence length for efficiency
-			examples.sort(key=lambda x: x[-1])
-			batches = [examples[i: i+n] for i in range(0, len(examples), n)]
-			np.random.shuffle(batches)
-
-			log('\nGenerated {} train batches of size {} in {:.3f} sec'.format(len(batches), n, time.time() - start))
+			batches = self._collect_train_group(pending)
+			#Double buffering: with a worker pool, the next group loads while this one is enqueued
+			pending = self._load_train_group(self._plan_train_group())
+
+			build_time = time.time() - start
+			log('\nGenerated {} train batches of size {} in {:.3f} sec'.format(len(batches),
+				n if self._hparams.tacotron_batch_frames is None else '{}-{}'.format(min(map(len, batches)), max(map(len, batches))), build_time))
+			if self._cache.max_bytes > 0:
+				log('Example cache: {} examples ({:.1f} MB), {} hits, {} misses ({:.1%} hit rate)'.format(
+					len(self._cache), self._cache.bytes / 2**20, self._cache.hits, self._cache.misses, self._cache.hit_rate))
+			target_frames = padded_frames = 0
 			for batch in batches:
-				feed_dict = dict(zip(self._placeholders, self._prepare_batch(batch, r)))
+				prepared = self._prepare_batch(batch, r, self._train_builder)
+				#targets_lengths and the per tower mel_target_max_len of split_infos
+				target_frames += prepared[7].sum()
+				padded_frames += prepared[8][:, 1].sum() * (len(batch) // self._hparams.tacotron_num_gpus)
+				feed_dict = self._feed_dict(prepared)
+				#Blocks while the queue is full
+				enqueue_start = time.time()
 				self._session.run(self._enqueue_op, feed_dict=feed_dict)
+				self._enqueued()
+				self.metrics.add_enqueue(time.time() - enqueue_start)
+			log('Train group padding efficiency: {:.1%} ({} target frames in {} padded frames)'.format(
+				target_frames / max(1, padded_frames), target_frames, padded_frames))
+			self.metrics.add_group(build_time, target_frames, padded_frames)
 
 	def _enqueue_next_test_group(self):
 		#Create test batches once and evaluate on them for all test steps
 		test_batches, r = self.make_test_batches()
 		while not self._coord.should_stop():
-			for batch in test_batches:
-				feed_dict = dict(zip(self._placeholders, self._prepare_batch(batch, r)))
-				self._session.run(self._eval_enqueue_op, feed_dict=feed_dict)
-
-	def _get_next_example(self):
-		"""Gets a single example (input, mel_target, token_target, linear_target, mel_length) from_ disk
+			for i, batch in enumerate(test_batches):
+				prepared = self._test_cache.get(i)
+				if prepared is None:
+					#Test examples are only needed for this batch, keep them out of the example cache
+					prepared = self._prepare_batch([self._loader(row) for row in batch], r, self._test_builder)
+					#Cached batches get their own arrays, the builder's buffers are reused. Batches larger than the
+					#cache budget are never stored, they are fed from the builder's buffers without a copy
+					nbytes = sum(x.nbytes for x in prepared if x is not None)
+					if nbytes <= self._test_cache.max_bytes:
+						prepared = tuple(np.array(x) if x is not None else None for x in prepared)
+						self._test_cache.put(i, prepared, nbytes)
+				self._session.run(self._eval_enqueue_op, feed_dict=self._feed_dict(prepared))
+
+	def _plan_train_group(self):
+		"""Draws the next group of training rows from the sampler and splits it in batches of rows
+
+		The plan only depends on the sampler position at the start of the group, so a restored sampler
+		plans the interrupted group again identically and its dequeued batches are skipped.
 		"""
-		if self._train_offset >= len(self._train_meta):
-			self._train_offset = 0
-			np.random.shuffle(self._train_meta)
-
-		meta = self._train_meta[self._train_offset]
-		self._train_offset += 1
-		text = meta[5]
-		input_data = np.asarray(text_to_sequence(text, self._cleaner_names), dtype=np.int32)
-		mel_target = np.load(os.path.join(self._mel_dir, meta[1]))
-		#Create parallel sequences containing zeros to represent a non finished sequence
-		token_target = np.asarray([0.] * (len(mel_target) - 1))
-		linear_target = np.load(os.path.join(self._linear_dir, meta[2]))
+		with self._progress_lock:
+			state = self._sampler.state()
+			rng = np.random.RandomState([state['seed'], state['epoch'], state['offset']])
+			rows = np.asarray([self._sampler.next() for i in range(self._hparams.tacotron_batch_size * _batches_per_group)])
 
-		speaker_label = np.asarray(int(meta[6]), dtype=np.int32)
-		language_label = np.asarray(int(meta[7]), dtype=np.int32)
-		return (input_data, speaker_label, language_label, mel_target, token_target, linear_target, len(mel_target))
+			# Bucket examples based on similar output sequence length for efficiency
+			rows = rows[np.argsort(self._metadata.mel_frames[rows], kind='stable')]
+			batches = self._make_train_batches(rows)
+			rng.shuffle(batches)
+			for batch in batches:
+				rng.shuffle(batch)
 
-	def _prepare_batch(self, batches, outputs_per_step):
-		assert 0 == len(batches) % self._hparams.tacotron_num_gpus
-		size_per_device = int(len(batches) / self._hparams.tacotron_num_gpus)
-		np.random.shuffle(batches)
-		inputs = None
-		speaker_labels=None
-		language_labels=None
-		mel_targets = None
-		token_targets = None
-		linear_targets = None
-		targets_lengths = None
-
-		split_infos = []
-
-		targets_lengths = np.asarray([x[-1] for x in batches], dtype=np.int32) #Used to mask loss
-		input_lengths = np.asarray([len(x[0]) for x in batches], dtype=np.int32)
-
-		for i in range(self._hparams.tacotron_num_gpus):
-			batch = batches[size_per_device*i:size_per_device*(i+1)]
-			input_cur_device, input_max_len = self._prepare_inputs([x[0] for x in batch])
-			inputs = np.concatenate((inputs, input_cur_device), axis=1) if inputs is not None else input_cur_device
-			speaker_label_cur_device = np.asarray([x[1] for x in batch], dtype=np.int32)
-			speaker_labels = np.concatenate((speaker_labels, speaker_label_cur_device),axis=0) if speaker_labels is not None else speaker_label_cur_device
-			language_label_cur_device = np.asarray([x[2] for x in batch], dtype=np.int32)
-			language_labels = np.concatenate((language_labels, language_label_cur_device),axis=0) if language_labels is not None else language_label_cur_device
-			mel_target_cur_device, mel_target_max_len = self._prepare_targets([x[3] for x in batch], outputs_per_step)
-			mel_targets = np.concatenate(( mel_targets, mel_target_cur_device), axis=1) if mel_targets is not None else mel_target_cur_device
-
-			#Pad sequences with 1 to infer that the sequence is done
-			token_target_cur_device, token_target_max_len = self._prepare_token_targets([x[4] for x in batch], outputs_per_step)
-			token_targets = np.concatenate((token_targets, token_target_cur_device),axis=1) if token_targets is not None else token_target_cur_device
-			linear_targets_cur_device, linear_target_max_len = self._prepare_targets([x[5] for x in batch], outputs_per_step)
-			linear_targets = np.concatenate((linear_targets, linear_targets_cur_device), axis=1) if linear_targets is not None else linear_targets_cur_device
-			split_infos.append([input_max_len, mel_target_max_len, token_target_max_len, linear_target_max_len])
-		split_infos = np.asarray(split_infos, dtype=np.int32)
-		return (inputs, speaker_labels, language_labels, input_lengths, mel_targets, token_targets, linear_targets, targets_lengths, split_infos)
-
-	def _prepare_inputs(self, inputs):
-		max_len = max([len(x) for x in inputs])
-		return np.stack([self._pad_input(x, max_len) for x in inputs]), max_len
-
-	def _prepare_targets(self, targets, alignment):
-		max_len = max([len(t) for t in targets])
-		data_len = self._round_up(max_len, alignment)
-		return np.stack([self._pad_target(t, data_len) for t in targets]), data_len
-
-	def _prepare_token_targets(self, targets, alignment):
-		max_len = max([len(t) for t in targets]) + 1
-		data_len = self._round_up(max_len, alignment)
-		return np.stack([self._pad_token_target(t, data_len) for t in targets]), data_len
-
-	def _pad_input(self, x, length):
-		return np.pad(x, (0, length - x.shape[0]), mode='constant', constant_values=self._pad)
-
-	def _pad_target(self, t, length):
-		return np.pad(t, [(0, length - t.shape[0]), (0, 0)], mode='constant', constant_values=self._target_pad)
-
-	def _pad_token_target(self, t, length):
-		return np.pad(t, (0, length - t.shape[0]), mode='constant', constant_values=self._token_pad)
+			skip, self._skip_batches = min(self._skip_batches, len(batches)), 0
+			if skip < len(batches):
+				self._groups.append([state, len(batches), skip])
+		return batches[skip:]
+
+	def _make_train_batches(self, rows):
+		"""Splits length sorted rows in batches of tacotron_batch_size examples or, if tacotron_batch_frames is set,
+		in batches of as many examples as fit in tacotron_batch_frames padded target frames
+		"""
+		n = self._hparams.tacotron_batch_size
+		budget = self._hparams.tacotron_batch_frames
+		if budget is None:
+			return [rows[i: i+n] for i in range(0, len(rows), n)]
+
+		#Batches grow num_gpus examples at a time so they split evenly across towers, the longest (last)
+		#example sets the padded length. A batch holds at least num_gpus examples, and the last
+		#(less than num_gpus) examples of the group are left out
+		num_gpus = self._hparams.tacotron_num_gpus
+		r = self._hparams.outputs_per_step
+		lengths = self._metadata.mel_frames
+		batches = []
+		start = 0
+		while len(rows) - start >= num_gpus:
+			end = start + num_gpus
+			while end + num_gpus <= len(rows) and \
+				(end + num_gpus - start) * self._round_up(lengths[rows[end + num_gpus - 1]], r) <= budget:
+				end += num_gpus
+			batches.append(rows[start:end])
+			start = end
+		return batches
+
+	def _load_train_group(self, plan):
+		"""Starts loading the examples of planned batches, cache misses are sent to the worker pool if there is one
+		"""
+		#close() may drop the pool from another thread
+		pool = self._pool
+		if pool is None:
+			#Loaded in the feeder thread by _collect_train_group
+			return plan, None, None
+		rows = [row for batch in plan for row in batch]
+		examples = [self._cache.get(row) for row in rows]
+		misses = [row for row, example in zip(rows, examples) if example is None]
+		chunksize = max(1, len(misses) // (4 * self._hparams.tacotron_data_workers))
+		return plan, examples, pool.map_async(_load_in_worker, misses, chunksize=chunksize)
+
+	def _collect_train_group(self, pending):
+		"""Waits for a group started by _load_train_group and returns its batches of examples
+		"""
+		plan, examples, result = pending
+		if result is None:
+			examples = [self._load_example(row) for batch in plan for row in batch]
+		else:
+			loaded = iter(result.get())
+			for i, row in enumerate(row for batch in plan for row in batch):
+				if examples[i] is None:
+					example, latency = next(loaded)
+					self.metrics.add_load_latency(latency)
+					examples[i] = self._cache_example(row, example)
+
+		examples = iter(examples)
+		return [[next(examples) for _ in batch] for batch in plan]
+
+	def _load_example(self, row):
+		example = self._cache.get(row)
+		if example is None:
+			start = time.time()
+			example = self._loader(row)
+			self.metrics.add_load_latency(time.time() - start)
+			example = self._cache_example(row, example)
+		return example
+
+	def _cache_example(self, row, example):
+		if self._cache.max_bytes == 0:
+			return example
+		#Copy arrays that are views on a shard memory map, so cached examples really are in memory
+		example = tuple(np.array(x) if isinstance(x, np.ndarray) and x.base is not None else x for x in example)
+		self._cache.put(row, example, sum(x.nbytes for x in example if isinstance(x, np.ndarray)))
+		return example
+
+	def _prepare_batch(self, batches, outputs_per_step, builder):
+		return builder.build(batches, outputs_per_step)
 
 	def _round_up(self, x, multiple):
 		remainder = x % multiple
@@ -0,0 +1,82 @@
+import json
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+
+class FeederMetrics:
+	"""
+		Thread safe accumulator of input pipeline measurements (example load latencies, enqueue blocking,
+		group build times and padding), drained by the training loop at each summary.
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._reset()
+
+	def _reset(self):
+		self._load_latencies = []
+		self._enqueue_block = 0.
+		self._enqueued_batches = 0
+		self._group_build = []
+		self._target_frames = 0
+		self._padded_frames = 0
+
+	def add_load_latency(self, seconds):
+		with self._lock:
+			self._load_latencies.append(seconds)
+
+	def add_enqueue(self, block_seconds):
+		with self._lock:
+			self._enqueue_block += block_seconds
+			self._enqueued_batches += 1
+
+	def add_group(self, build_seconds, target_frames, padded_frames):
+		with self._lock:
+			self._group_build.append(build_seconds)
+			self._target_frames += int(target_frames)
+			self._padded_frames += int(padded_frames)
+
+	def drain(self):
+		"""Returns the measurements since the previous call
+
+		Returns:
+			- load_latencies: per example load times (sec) of examples read from disk
+			- a dict of scalar metrics
+		"""
+		with self._lock:
+			load_latencies = np.asarray(self._load_latencies, dtype=np.float64)
+			scalars = {
+				'loaded_examples': len(load_latencies),
+				'load_latency_mean_ms': 1000 * load_latencies.mean() if len(load_latencies) else 0.,
+				'load_latency_p95_ms': 1000 * np.percentile(load_latencies, 95) if len(load_latencies) else 0.,
+				'enqueued_batches': self._enqueued_batches,
+				'enqueue_block_sec_per_batch': self._enqueue_block / max(1, self._enqueued_batches),
+				'groups': len(self._group_build),
+				'group_build_sec': float(np.mean(self._group_build)) if self._group_build else 0.,
+				'padding_ratio': 1. - self._target_frames / self._padded_frames if self._padded_frames else 0.,
+				}
+			self._reset()
+		return load_latencies, scalars
+
+
+def add_feeder_stats(summary_writer, step, metrics, queue_size=None, log_path=None):
+	"""Writes the drained feeder metrics to tensorboard and, optionally, appends them as a json line to log_path
+	"""
+	load_latencies, scalars = metrics.drain()
+	if queue_size is not None:
+		scalars['queue_size'] = int(queue_size)
+
+	values = [tf.Summary.Value(tag='Tacotron_model/feeder/{}'.format(name), simple_value=value) for name, value in sorted(scalars.items())]
+	if len(load_latencies):
+		counts, edges = np.histogram(1000 * load_latencies, bins=30)
+		values.append(tf.Summary.Value(tag='Tacotron_model/feeder/load_latency_ms', histo=tf.HistogramProto(
+			min=1000 * load_latencies.min(), max=1000 * load_latencies.max(), num=len(load_latencies),
+			sum=1000 * load_latencies.sum(), sum_squares=float(np.sum((1000 * load_latencies) ** 2)),
+			bucket_limit=edges[1:].tolist(), bucket=counts.tolist())))
+	summary_writer.add_summary(tf.Summary(value=values), step)
+
+	if log_path is not None:
+		with open(log_path, 'a') as f:
+			f.write(json.dumps(dict(scalars, step=int(step))) + '\n')
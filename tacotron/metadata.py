@@ -0,0 +1,88 @@
+import os
+import time
+
+import numpy as np
+from infolog import log
+
+#Bump when the sidecar layout changes
+_version = 1
+#train.txt columns: audio_filename|mel_filename|linear_filename|time_steps|mel_frames|text|speaker_num|lan_num
+_string_columns = [0, 1, 2, 5]
+
+
+class MetadataIndex:
+	"""
+		Columnar view of a train.txt metadata file, examples are referred to by row index.
+
+		Integer columns are int32 arrays (time_steps, mel_frames, speakers, languages). The string columns
+		(audio, mel and linear filenames, text) are packed in one utf-8 byte pool, string k of row i spanning
+		pool[offsets[4*i + k]:offsets[4*i + k + 1]].
+
+		The parsed index is saved next to the metadata file (<name>_index.npz) and loaded directly
+		by the next runs, as long as the metadata file is unchanged.
+	"""
+
+	def __init__(self, metadata_filename):
+		self.metadata_filename = metadata_filename
+		self.path = os.path.splitext(metadata_filename)[0] + '_index.npz'
+		stat = os.stat(metadata_filename)
+		self.signature = '{}|{}|{}'.format(_version, stat.st_size, stat.st_mtime_ns)
+
+		if not self._load():
+			start = time.time()
+			self._parse(metadata_filename)
+			tmp_path = self.path + '.tmp.npz'
+			np.savez(tmp_path, signature=np.asarray(self.signature), pool=self._pool, offsets=self._offsets,
+				time_steps=self.time_steps, mel_frames=self.mel_frames, speakers=self.speakers, languages=self.languages)
+			os.replace(tmp_path, self.path)
+			log('Indexed {} metadata rows in {:.3f} sec ({})'.format(len(self), time.time() - start, self.path))
+
+	def _load(self):
+		if not os.path.isfile(self.path):
+			return False
+		with np.load(self.path) as data:
+			if str(data['signature']) != self.signature:
+				return False
+			self._pool, self._offsets = data['pool'], data['offsets']
+			self.time_steps, self.mel_frames = data['time_steps'], data['mel_frames']
+			self.speakers, self.languages = data['speakers'], data['languages']
+		return True
+
+	def _parse(self, metadata_filename):
+		strings = []
+		time_steps, mel_frames, speakers, languages = [], [], [], []
+		with open(metadata_filename, encoding='utf-8') as f:
+			for line in f:
+				fields = line.strip().split('|')
+				strings.extend(fields[i].encode('utf-8') for i in _string_columns)
+				time_steps.append(int(fields[3]))
+				mel_frames.append(int(fields[4]))
+				speakers.append(int(fields[6]))
+				languages.append(int(fields[7]))
+
+		self._offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+		np.cumsum([len(s) for s in strings], out=self._offsets[1:])
+		self._pool = np.frombuffer(b''.join(strings), dtype=np.uint8)
+		self.time_steps = np.asarray(time_steps, dtype=np.int32)
+		self.mel_frames = np.asarray(mel_frames, dtype=np.int32)
+		self.speakers = np.asarray(speakers, dtype=np.int32)
+		self.languages = np.asarray(languages, dtype=np.int32)
+
+	def __len__(self):
+		return len(self.mel_frames)
+
+	def _string(self, row, column):
+		k = len(_string_columns) * row + column
+		return self._pool[self._offsets[k]:self._offsets[k + 1]].tobytes().decode('utf-8')
+
+	def audio_filename(self, row):
+		return self._string(row, 0)
+
+	def mel_filename(self, row):
+		return self._string(row, 1)
+
+	def linear_filename(self, row):
+		return self._string(row, 2)
+
+	def text(self, row):
+		return self._string(row, 3)
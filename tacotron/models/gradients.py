@@ -0,0 +1,54 @@
+import tensorflow as tf
+
+
+def average_gradients(tower_gradients, fusion_bytes=0):
+	'''Averages the gradients of each variable over the towers.
+
+	Gradients are summed with a single add_n per variable (no stacked [towers, ...] copy), sparse gradients
+	(embeddings) are densified. With fusion_bytes > 0, gradients smaller than fusion_bytes are reduced in
+	flat buffers of up to fusion_bytes: one concat per tower and one add_n per buffer instead of one add_n
+	per variable, which saves most of the per op overhead for the many small bias and normalization gradients.
+
+	Args:
+		- tower_gradients: list (one per tower) of lists of (gradient, variable), as returned by compute_gradients
+		- fusion_bytes: size limit of the fused buffers, 0 to reduce every gradient separately
+
+	Returns:
+		- list of (average gradient, variable), in the order of the variables
+	'''
+	num_towers = len(tower_gradients)
+	variables = [v for _, v in tower_gradients[0]]
+	#[variable][tower] dense gradients
+	gradients = [[tf.convert_to_tensor(g) for g, _ in grad_and_vars] for grad_and_vars in zip(*tower_gradients)]
+
+	averages = [None] * len(variables)
+	buckets = []
+	bucket, bucket_bytes = [], 0
+	for i, v in enumerate(variables):
+		size = v.shape.num_elements() * v.dtype.base_dtype.size
+		if num_towers > 1 and 0 < size < fusion_bytes:
+			if bucket_bytes + size > fusion_bytes:
+				buckets.append(bucket)
+				bucket, bucket_bytes = [], 0
+			bucket.append(i)
+			bucket_bytes += size
+		else:
+			averages[i] = _average(gradients[i])
+	if bucket:
+		buckets.append(bucket)
+
+	for bucket in buckets:
+		#Fused buffers hold gradients of a single dtype
+		for dtype in set(variables[i].dtype.base_dtype for i in bucket):
+			indices = [i for i in bucket if variables[i].dtype.base_dtype == dtype]
+			flat = _average([tf.concat([tf.reshape(gradients[i][t], [-1]) for i in indices], axis=0) for t in range(num_towers)])
+			sizes = [variables[i].shape.num_elements() for i in indices]
+			for i, g in zip(indices, tf.split(flat, sizes)):
+				averages[i] = tf.reshape(g, variables[i].shape)
+
+	return list(zip(averages, variables))
+
+def _average(gradients):
+	if len(gradients) == 1:
+		return gradients[0]
+	return tf.add_n(gradients) / len(gradients)
@@ -7,18 +7,10 @@ from tensorflow.contrib.seq2seq import dynamic_decode
 from tacotron.models.Architecture_wrappers import TacotronEncoderCell, VAECell, TacotronDecoderCell
 from tacotron.models.custom_decoder import CustomDecoder
 from tacotron.models.attention import LocationSensitiveAttention
+from tacotron.models.gradients import average_gradients
 
 import numpy as np
 
-def split_func(x, split_pos):
-	rst = []
-	start = 0
-	# x will be a numpy array with the contents of the placeholder below
-	for i in range(split_pos.shape[0]):
-		rst.append(x[:,start:start+split_pos[i]])
-		start += split_pos[i]
-	return rst
-
 class Tacotron():
 	"""Tacotron-2 Feature prediction Model.
 	"""
@@ -57,18 +49,17 @@ class Tacotron():
 		split_device = '/cpu:0' if self._hparams.tacotron_num_gpus > 1 or self._hparams.split_on_cpu else '/gpu:{}'.format(self._hparams.tacotron_gpu_start_idx)
 		with tf.device(split_device):
 			hp = self._hparams
-			lout_int = [tf.int32]*hp.tacotron_num_gpus
-			lout_float = [tf.float32]*hp.tacotron_num_gpus
 
 			tower_input_lengths = tf.split(input_lengths, num_or_size_splits=hp.tacotron_num_gpus, axis=0)
 			tower_targets_lengths = tf.split(targets_lengths, num_or_size_splits=hp.tacotron_num_gpus, axis=0) if targets_lengths is not None else targets_lengths
 			tower_speaker_labels = tf.split(speaker_labels, num_or_size_splits=hp.tacotron_num_gpus, axis=0)
 			tower_language_labels = tf.split(language_labels, num_or_size_splits=hp.tacotron_num_gpus, axis=0)
 
-			p_inputs = tf.py_func(split_func, [inputs, split_infos[:, 0]], lout_int)
-			p_mel_targets = tf.py_func(split_func, [mel_targets, split_infos[:,1]], lout_float) if mel_targets is not None else mel_targets
-			p_stop_token_targets = tf.py_func(split_func, [stop_token_targets, split_infos[:,2]], lout_float) if stop_token_targets is not None else stop_token_targets
-			p_linear_targets = tf.py_func(split_func, [linear_targets, split_infos[:, 3]], lout_float) if linear_targets is not None else linear_targets
+			#Towers are concatenated along the time axis, split_infos holds the width of each tower
+			p_inputs = tf.split(inputs, split_infos[:, 0], axis=1, num=hp.tacotron_num_gpus)
+			p_mel_targets = tf.split(mel_targets, split_infos[:, 1], axis=1, num=hp.tacotron_num_gpus) if mel_targets is not None else mel_targets
+			p_stop_token_targets = tf.split(stop_token_targets, split_infos[:, 2], axis=1, num=hp.tacotron_num_gpus) if stop_token_targets is not None else stop_token_targets
+			p_linear_targets = tf.split(linear_targets, split_infos[:, 3], axis=1, num=hp.tacotron_num_gpus) if linear_targets is not None else linear_targets
 
 			tower_inputs = []
 			tower_mel_targets = []
@@ -111,7 +102,8 @@ class Tacotron():
 						assert global_step is not None
 
 					#GTA is only used for predicting mels to train Wavenet vocoder, so we ommit post processing when doing GTA synthesis
-					post_condition = hp.predict_linear and not gta
+					#(as well as in synthesis when only mels are wanted, see tacotron_synthesis_linear)
+					post_condition = hp.predict_linear and not gta and (is_training or is_evaluating or hp.tacotron_synthesis_linear)
 
 					# Embeddings ==> [batch_size, sequence_length, embedding_dim]
 					self.embedding_table = tf.get_variable(
@@ -136,9 +128,12 @@ class Tacotron():
 					enc_conv_output_shape = encoder_cell.conv_output_shape
 
 					# Adversarial Speaker-Classifiers,	input:encoder_output,output:predicted speaker_label
-					speaker_classify = Speaker_Classifier(is_training, layer_size=hp.softmax_hidden_layer,
-														  speaker_size=hp.speaker_num)
-					predict_speaker_labels = speaker_classify(encoder_outputs, hp.grad_rev_scale)
+					# (only used by the adversarial loss, not built for synthesis)
+					if is_training or is_evaluating:
+						speaker_classify = Speaker_Classifier(is_training, layer_size=hp.softmax_hidden_layer,
+															  speaker_size=hp.speaker_num)
+						predict_speaker_labels = speaker_classify(encoder_outputs, hp.grad_rev_scale)
+						self.tower_predict_speaker_labels.append(predict_speaker_labels)
 
 					# Variational AutoEncoder
 					if is_training:
@@ -146,12 +141,11 @@ class Tacotron():
 										   VAERNN(is_training, layers=hp.VAE_lstm_num_layers,
 												  size=hp.VAE_lstm_layer_size,
 												  zoneout=hp.tacotron_zoneout_rate, scope='VAE_LSTM'), hp.VAE_pool_size, hp.VAE_D_size)
-						residual_encoding, self.kl_div = VAE_cell(tower_mel_targets[i], hp.tacotron_batch_size)
-					elif is_evaluating:
-						residual_encoding,self.kl_div = tf.zeros([hp.tacotron_batch_size, hp.VAE_D_size], dtype=tf.float32), 0
+						#Batches are not always tacotron_batch_size examples (see tacotron_batch_frames), normalize by the actual one
+						residual_encoding, self.kl_div = VAE_cell(tower_mel_targets[i], tf.cast(batch_size * hp.tacotron_num_gpus, tf.float32))
 					else:
-						residual_encoding = tf.zeros([hp.tacotron_synthesis_batch_size, hp.VAE_D_size],
-													 dtype=tf.float32)
+						#Synthesis batches can be of any size
+						residual_encoding,self.kl_div = tf.zeros([batch_size, hp.VAE_D_size], dtype=tf.float32), 0
 					self.residual_encoding=residual_encoding
 					#Decoder Parts
 					#Attention Decoder Prenet
@@ -244,7 +238,6 @@ class Tacotron():
 					self.tower_alignments.append(alignments)
 					self.tower_stop_token_prediction.append(stop_token_prediction)
 					self.tower_mel_outputs.append(mel_outputs)
-					self.tower_predict_speaker_labels.append(predict_speaker_labels)
 					tower_embedded_inputs.append(embedded_inputs)
 					tower_enc_conv_output_shape.append(enc_conv_output_shape)
 					tower_encoder_outputs.append(encoder_outputs)
@@ -405,7 +398,12 @@ class Tacotron():
 		self.loss = total_loss / hp.tacotron_num_gpus
 
 	def add_optimizer(self, global_step):
-		'''Adds optimizer. Sets "gradients" and "optimize" fields. add_loss must have been called.
+		'''Adds optimizer. Sets "gradients", "accumulate" and "optimize" fields. add_loss must have been called.
+
+		With tacotron_accumulation_steps = K > 1, the gradients of K micro batches are summed into accumulators
+		before being applied: "accumulate" adds the gradients of a batch, "optimize" adds the gradients of the
+		last batch then applies (and resets) their average. A training step is K-1 runs of "accumulate" then a
+		run of "optimize", which increments global_step once.
 		Args:
 			global_step: int32 scalar Tensor representing current global step in training
 		'''
@@ -440,22 +438,24 @@ class Tacotron():
 
 		# 3. Average Gradient
 		with tf.device(grad_device) :
-			avg_grads = []
-			vars = []
-			for grad_and_vars in zip(*tower_gradients):
-				# grads_vars = [(grad1, var), (grad2, var), ...]
-				grads = []
-				for g,_ in grad_and_vars:
-					expanded_g = tf.expand_dims(g, 0)
-					# Append on a 'tower' dimension which we will average over below.
-					grads.append(expanded_g)
-					# Average over the 'tower' dimension.
-				grad = tf.concat(axis=0, values=grads)
-				grad = tf.reduce_mean(grad, 0)
-
-				v = grad_and_vars[0][1]
-				avg_grads.append(grad)
-				vars.append(v)
+			avg_grads, vars = map(list, zip(*average_gradients(tower_gradients, hp.tacotron_gradient_fusion_bytes)))
+
+			accumulation_steps = hp.tacotron_accumulation_steps
+			if accumulation_steps > 1:
+				#Accumulators live next to the tower averaged gradients, only the micro batch activations are on the towers
+				#They are local variables: zero after each update, they are not checkpointed (the accumulation steps can change on restore)
+				with tf.variable_scope('optimizer'):
+					accumulators = [tf.Variable(tf.zeros(v.shape, dtype=v.dtype.base_dtype), trainable=False,
+						collections=[tf.GraphKeys.LOCAL_VARIABLES], name='gradient_accumulator') for v in vars]
+
+				with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
+					self.accumulate = tf.group(*[accumulator.assign_add(grad) for accumulator, grad in zip(accumulators, avg_grads)])
+
+				#The gradients of the effective batch (clipped and applied below) are read once the last batch is added
+				with tf.control_dependencies([self.accumulate]):
+					avg_grads = [accumulator.read_value() / accumulation_steps for accumulator in accumulators]
+			else:
+				self.accumulate = None
 
 			self.gradients = avg_grads
 			#Just for causion
@@ -467,10 +467,16 @@ class Tacotron():
 
 			# Add dependency on UPDATE_OPS; otherwise batchnorm won't work correctly. See:
 			# https://github.com/tensorflow/tensorflow/issues/1122
-			with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
+			# (with accumulation, they already ran with each accumulated batch)
+			update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS) if accumulation_steps == 1 else []
+			with tf.control_dependencies(update_ops):
 				self.optimize = optimizer.apply_gradients(zip(clipped_gradients, vars),
 					global_step=global_step)
 
+			if accumulation_steps > 1:
+				with tf.control_dependencies([self.optimize]):
+					self.optimize = tf.group(*[accumulator.assign(tf.zeros_like(accumulator)) for accumulator in accumulators])
+
 	def _learning_rate_decay(self, init_lr, global_step):
 		#################################################################
 		# Narrow Exponential Decay:
@@ -0,0 +1,41 @@
+import numpy as np
+
+
+class EpochSampler:
+	"""
+		Seeded epoch sampler: epoch e visits every row once, in an order drawn from (seed, e).
+
+		The (epoch, offset) position fully determines the rows to come, so saving it is enough
+		to resume sampling exactly where it stopped.
+	"""
+
+	def __init__(self, rows, seed):
+		self.seed = seed
+		self._rows = np.asarray(rows)
+		self.epoch = 0
+		self.offset = 0
+		self._order = self._permutation(self.epoch)
+
+	def _permutation(self, epoch):
+		return self._rows[np.random.RandomState([self.seed, epoch]).permutation(len(self._rows))]
+
+	def next(self):
+		if self.offset >= len(self._order):
+			self.epoch += 1
+			self.offset = 0
+			self._order = self._permutation(self.epoch)
+
+		row = self._order[self.offset]
+		self.offset += 1
+		return row
+
+	def state(self):
+		return {'seed': self.seed, 'size': len(self._rows), 'epoch': self.epoch, 'offset': self.offset}
+
+	def restore(self, state):
+		if state['seed'] != self.seed or state['size'] != len(self._rows):
+			raise ValueError('Sampler state (seed={}, size={}) does not match this sampler (seed={}, size={})'.format(
+				state['seed'], state['size'], self.seed, len(self._rows)))
+		self.epoch = state['epoch']
+		self.offset = state['offset']
+		self._order = self._permutation(self.epoch)
@@ -4,7 +4,9 @@ import re
 import time
 from time import sleep
 
+import numpy as np
 import tensorflow as tf
+from datasets import feature_store
 from hparams import hparams, hparams_debug_string
 from infolog import log
 from tacotron.synthesizer import Synthesizer
@@ -72,6 +74,18 @@ def run_eval(args, checkpoint_path, output_dir, hparams, sentences, speaker_labe
 	log('synthesized mel spectrograms at {}'.format(eval_dir))
 	return eval_dir
 
+def export_feature(path, out_dir):
+	"""Returns the path of a .npy file holding the array saved at path
+
+	Arrays preprocessed with use_feature_store live in shards (path is their key), they are written to out_dir
+	so consumers of map.txt (e.g. the vocoder) can np.load them.
+	"""
+	if os.path.isfile(path):
+		return path
+	out_path = os.path.join(out_dir, os.path.basename(path))
+	np.save(out_path, feature_store.load(path), allow_pickle=False)
+	return out_path
+
 def run_synthesis(args, checkpoint_path, output_dir, hparams):
 	GTA = (args.GTA == 'True')
 	if GTA:
@@ -102,6 +116,11 @@ def run_synthesis(args, checkpoint_path, output_dir, hparams):
 	log('Starting Synthesis')
 	mel_dir = os.path.join(args.input_dir, 'mels')
 	wav_dir = os.path.join(args.input_dir, 'audio')
+	#Ground truth features stored in shards are exported next to the synthesized mels
+	target_mel_dir = os.path.join(synth_dir, 'target_mels')
+	target_wav_dir = os.path.join(synth_dir, 'audio')
+	os.makedirs(target_mel_dir, exist_ok=True)
+	os.makedirs(target_wav_dir, exist_ok=True)
 	with open(os.path.join(synth_dir, 'map.txt'), 'w') as file:
 		for i, meta in enumerate(tqdm(metadata)):
 			texts = [m[5] for m in meta]
@@ -109,6 +128,8 @@ def run_synthesis(args, checkpoint_path, output_dir, hparams):
 			wav_filenames = [os.path.join(wav_dir, m[0]) for m in meta]
 			basenames = [os.path.basename(m).replace('.npy', '').replace('mel-', '') for m in mel_filenames]
 			mel_output_filenames, speaker_ids = synth.synthesize(texts, basenames, synth_dir, None, mel_filenames)
+			wav_filenames = [export_feature(filename, target_wav_dir) for filename in wav_filenames]
+			mel_filenames = [export_feature(filename, target_mel_dir) for filename in mel_filenames]
 
 			for elems in zip(wav_filenames, mel_filenames, mel_output_filenames, speaker_ids, texts):
 				file.write('|'.join([str(x) for x in elems]) + '\n')
@@ -1,10 +1,11 @@
 import os
+import time
 import wave
 from datetime import datetime
 
 import numpy as np
 import tensorflow as tf
-from datasets import audio
+from datasets import audio, feature_store
 from infolog import log
 from librosa import effects
 from tacotron.models import create_model
@@ -30,7 +31,8 @@ class Synthesizer:
 				self.model.initialize(inputs, speaker_labels, language_labels, input_lengths, split_infos=split_infos)
 
 			self.mel_outputs = self.model.tower_mel_outputs
-			self.linear_outputs = self.model.tower_linear_outputs if (hparams.predict_linear and not gta) else None
+			#Linear outputs are only built when predict_linear and tacotron_synthesis_linear (and not in GTA mode)
+			self.linear_outputs = self.model.tower_linear_outputs if self.model.tower_linear_outputs else None
 			self.alignments = self.model.tower_alignments
 			self.stop_token_prediction = self.model.tower_stop_token_prediction
 			self.targets = targets
@@ -59,18 +61,24 @@ class Synthesizer:
 		config.gpu_options.allow_growth = True
 		config.allow_soft_placement = True
 
+		graph_def = tf.get_default_graph().as_graph_def()
+		log('Synthesis graph: {} ops, {:.2f} MB GraphDef'.format(len(graph_def.node), graph_def.ByteSize() / 1024 ** 2))
+
+		start = time.time()
 		self.session = tf.Session(config=config)
 		self.session.run(tf.global_variables_initializer())
 
+		#Only the variables of the synthesis graph are restored (training only ones, e.g. the speaker classifier, are not built)
 		saver = tf.train.Saver()
 		saver.restore(self.session, checkpoint_path)
+		log('Restored checkpoint in {:.3f} sec'.format(time.time() - start))
 
 	def synthesize(self, texts, speaker_labels, language_labels, basenames, out_dir, log_dir, mel_filenames):
 		hparams = self._hparams
 		cleaner_names = [x.strip() for x in hparams.cleaners.split(',')]
 
 		#Repeat last sample until number of samples is dividable by the number of GPUs (last run scenario)
-		while len(texts) % hparams.tacotron_synthesis_batch_size != 0:
+		while len(texts) % hparams.tacotron_num_gpus != 0:
 			texts.append(texts[-1])
 			basenames.append(basenames[-1])
 			if mel_filenames is not None:
@@ -107,7 +115,7 @@ class Synthesizer:
 		}
 
 		if self.gta:
-			np_targets = [np.load(mel_filename) for mel_filename in mel_filenames]
+			np_targets = [feature_store.load(mel_filename) for mel_filename in mel_filenames]
 			target_lengths = [len(np_target) for np_target in np_targets]
 
 			#pad targets according to each GPU max length
@@ -122,7 +130,8 @@ class Synthesizer:
 			assert len(np_targets) == len(texts)
 
 		feed_dict[self.split_infos] = np.asarray(split_infos, dtype=np.int32)
-		if self.gta or not hparams.predict_linear:
+		start = time.time()
+		if self.linear_outputs is None:
 			mels, alignments, stop_tokens = self.session.run([self.mel_outputs, self.alignments, self.stop_token_prediction], feed_dict=feed_dict)
 			#Linearize outputs (1D arrays)
 			mels = [mel for gpu_mels in mels for mel in gpu_mels]
@@ -148,14 +157,16 @@ class Synthesizer:
 
 			#Natural batch synthesis
 			#Get Mel/Linear lengths for the entire batch from stop_tokens predictions
-			# target_lengths = self._get_output_lengths(stop_tokens)
-			target_lengths = [9999]
+			target_lengths = self._get_output_lengths(stop_tokens)
 
 			#Take off the batch wise padding
 			mels = [mel[:target_length, :] for mel, target_length in zip(mels, target_lengths)]
 			linears = [linear[:target_length, :] for linear, target_length in zip(linears, target_lengths)]
 			assert len(mels) == len(linears) == len(texts)
 
+		elapsed = time.time() - start
+		log('Synthesized {} utterances in {:.3f} sec ({:.3f} sec/utterance)'.format(len(texts), elapsed, elapsed / len(texts)))
+
 		if basenames is None:
 			#Generate wav and read it
 			wav = audio.inv_mel_spectrogram(mels.T, hparams)
@@ -211,7 +222,7 @@ class Synthesizer:
 				plot.plot_spectrogram(mel, os.path.join(log_dir, 'plots/mel-{}.png'.format(basenames[i])),
 					title='{}'.format(texts[i]), split_title=True)
 
-				if hparams.predict_linear:
+				if self.linear_outputs is not None:
 					#save wav (linear -> wav)
 					wav = audio.inv_linear_spectrogram(linears[i].T, hparams)
 					audio.save_wav(wav, os.path.join(log_dir, 'wavs/wav-{}-linear.wav'.format(basenames[i])), sr=hparams.sample_rate)
@@ -245,5 +256,6 @@ class Synthesizer:
 
 	def _get_output_lengths(self, stop_tokens):
 		#Determine each mel length by the stop token predictions. (len = first occurence of 1 in stop_tokens row wise)
-		output_lengths = [row.index(1) for row in np.round(stop_tokens).tolist()]
+		#Outputs that never predicted a stop token (max_iters reached) are kept whole
+		output_lengths = [row.index(1) if 1 in row else len(row) for row in np.round(stop_tokens).tolist()]
 		return output_lengths
@@ -4,15 +4,20 @@ import subprocess
 import time
 import traceback
 from datetime import datetime
+from functools import partial
 
 import infolog
 import numpy as np
 import tensorflow as tf
-from datasets import audio
 from hparams import hparams_debug_string
+from tacotron.artifact_writer import ArtifactWriter
+from tacotron.async_saver import AsyncSaver
+from tacotron.dataset_feeder import DatasetFeeder
 from tacotron.feeder import Feeder
+from tacotron.feeder_metrics import add_feeder_stats
 from tacotron.models import create_model
-from tacotron.utils import ValueWindow, plot
+from tacotron.utils import ValueWindow
+from tacotron.utils.profiling import write_profile
 from tacotron.utils.text import sequence_to_text
 from tacotron.utils.symbols import symbols
 from tqdm import tqdm
@@ -60,6 +65,14 @@ def add_train_stats(model, hparams):
 		tf.summary.scalar('max_gradient_norm', tf.reduce_max(gradient_norms)) #visualize gradients (in case of explosion)
 		return tf.summary.merge_all()
 
+def batch_composition(input_lengths, targets_lengths, split_infos):
+	"""Returns the (utterances, input tokens, mel frames, padded input tokens, padded mel frames) of a training batch
+	"""
+	#Towers are concatenated along the time axis, each row of the batch holds one example of each tower
+	rows = len(input_lengths) // len(split_infos)
+	return (len(input_lengths), int(input_lengths.sum()), int(targets_lengths.sum()),
+		int(split_infos[:, 0].sum()) * rows, int(split_infos[:, 1].sum()) * rows)
+
 def add_eval_stats(summary_writer, step, linear_loss, before_loss, after_loss, stop_token_loss, loss):
 	values = [
 	tf.Summary.Value(tag='Tacotron_eval_model/eval_stats/eval_before_loss', simple_value=before_loss),
@@ -119,6 +132,7 @@ def train(log_dir, args, hparams):
 	eval_wav_dir = os.path.join(eval_dir, 'wavs')
 	tensorboard_dir = os.path.join(log_dir, 'tacotron_events')
 	meta_folder = os.path.join(log_dir, 'metas')
+	profile_dir = os.path.join(log_dir, 'profile')
 	os.makedirs(save_dir, exist_ok=True)
 	os.makedirs(plot_dir, exist_ok=True)
 	os.makedirs(wav_dir, exist_ok=True)
@@ -147,7 +161,12 @@ def train(log_dir, args, hparams):
 	#Set up data feeder
 	coord = tf.train.Coordinator()
 	with tf.variable_scope('datafeeder') as scope:
-		feeder = Feeder(coord, input_path, hparams)
+		if hparams.tacotron_input_pipeline == 'dataset':
+			feeder = DatasetFeeder(coord, input_path, hparams)
+		elif hparams.tacotron_input_pipeline == 'queue':
+			feeder = Feeder(coord, input_path, hparams)
+		else:
+			raise ValueError('Unsupported tacotron_input_pipeline provided: {} (expected "queue" or "dataset")'.format(hparams.tacotron_input_pipeline))
 
 	#Set up model:
 	global_step = tf.Variable(0, name='global_step', trainable=False)
@@ -170,7 +189,22 @@ def train(log_dir, args, hparams):
 	step = 0
 	time_window = ValueWindow(100)
 	loss_window = ValueWindow(100)
+	wait_window = ValueWindow(100)
+	#Batch composition windows, for throughput normalized by the real (unpadded) amount of data
+	utterance_window = ValueWindow(100)
+	token_window = ValueWindow(100)
+	frame_window = ValueWindow(100)
+	padded_token_window = ValueWindow(100)
+	padded_frame_window = ValueWindow(100)
 	saver = tf.train.Saver(max_to_keep=5)
+	#Checkpoints written in the background are snapshotted when saved, the sampler position is taken at the same time
+	async_saver = AsyncSaver(tf.global_variables(), max_to_keep=5, saver_def=saver.as_saver_def()) if args.async_checkpoints else None
+
+	def save_checkpoint(sess):
+		if async_saver is None:
+			feeder.save_sampler_state(saver.save(sess, checkpoint_path, global_step=global_step))
+		else:
+			async_saver.save(sess, checkpoint_path, global_step, on_saved=partial(feeder.save_sampler_state, state=feeder.sampler_state()))
 
 	log('Tacotron training set to a maximum of {} steps'.format(args.tacotron_train_steps))
 
@@ -179,12 +213,14 @@ def train(log_dir, args, hparams):
 	config.gpu_options.allow_growth = True
 	config.allow_soft_placement = True
 
+	artifacts = None
+
 	#Train
 	with tf.Session(config=config) as sess:
 		try:
 			summary_writer = tf.summary.FileWriter(tensorboard_dir, sess.graph)
 
-			sess.run(tf.global_variables_initializer())
+			sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
 
 			#saved model restoring
 			if args.restore:
@@ -195,28 +231,89 @@ def train(log_dir, args, hparams):
 					if (checkpoint_state and checkpoint_state.model_checkpoint_path):
 						log('Loading checkpoint {}'.format(checkpoint_state.model_checkpoint_path), slack=True)
 						saver.restore(sess, checkpoint_state.model_checkpoint_path)
+						feeder.restore_sampler_state(checkpoint_state.model_checkpoint_path)
 
 					else:
 						log('No model to load at {}'.format(save_dir), slack=True)
-						saver.save(sess, checkpoint_path, global_step=global_step)
+						save_checkpoint(sess)
 
 				except tf.errors.OutOfRangeError as e:
 					log('Cannot restore checkpoint: {}'.format(e), slack=True)
 			else:
 				log('Starting new training!', slack=True)
-				saver.save(sess, checkpoint_path, global_step=global_step)
+				save_checkpoint(sess)
+
+			#The first checkpoint is on disk before training starts (the embeddings projector refers to it)
+			if async_saver is not None:
+				async_saver.wait()
 
 			#initializing feeder
 			feeder.start_threads(sess)
 
+			#Griffin-Lim inversions and plots are written by another process, the loop only fetches their arrays
+			artifacts = ArtifactWriter(hparams, args.artifact_queue_size)
+
+			#Diagnostic tensors are fetched in the training step run of the steps that need them, another run would dequeue (and skip) a batch
+			diagnostics = {
+				'input_seq': model.tower_inputs[0][0],
+				'mel_prediction': model.tower_mel_outputs[0][0],
+				'alignment': model.tower_alignments[0][0],
+				'target': model.tower_mel_targets[0][0],
+				'target_length': model.tower_targets_lengths[0][0],
+				}
+			if hparams.predict_linear:
+				diagnostics['linear_prediction'] = model.tower_linear_outputs[0][0]
+				diagnostics['linear_target'] = model.tower_linear_targets[0][0]
+
+			def is_checkpoint_step(step):
+				return step % args.checkpoint_interval == 0 or step == args.tacotron_train_steps or step == 300
+
+			def run_batch(fetches, **kwargs):
+				#Every training run dequeues one batch, reported to the feeder once the run is done
+				run_start = time.time()
+				results = sess.run(fetches, **kwargs)
+				feeder.mark_consumed(run_start)
+				return results
+
+			#Each training step increments global_step by one, the step number of a run is known before the run
+			step = sess.run(global_step)
+
 			#Training loop
 			while not coord.should_stop() and step < args.tacotron_train_steps:
 				start_time = time.time()
-				step, loss, opt = sess.run([global_step, model.loss, model.optimize])
+				next_step = step + 1
+				batch_fetches = {'loss': model.loss, 'composition': (feeder.input_lengths, feeder.targets_lengths, feeder.split_infos)}
+				#With gradient accumulation, the gradients of the first tacotron_accumulation_steps - 1 batches of the step are only accumulated
+				accumulated = [run_batch(dict(batch_fetches, accumulate=model.accumulate)) for _ in range(hparams.tacotron_accumulation_steps - 1)]
+				fetches = dict(batch_fetches, optimize=model.optimize)
+				if next_step % args.summary_interval == 0:
+					fetches['stats'] = stats
+					if feeder.queue_size is not None:
+						fetches['queue_size'] = feeder.queue_size
+				if is_checkpoint_step(next_step):
+					fetches['diagnostics'] = diagnostics
+				if args.profile_interval > 0 and next_step % args.profile_interval == 0:
+					#Traced steps are slower, their per op timeline and per scope report are written to profile_dir
+					run_metadata = tf.RunMetadata()
+					results = run_batch(fetches, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+					write_profile(run_metadata, profile_dir, next_step, summary_writer)
+				else:
+					results = run_batch(fetches)
+				batch_results = accumulated + [results]
+				step, loss = next_step, float(np.mean([r['loss'] for r in batch_results]))
 				time_window.append(time.time() - start_time)
 				loss_window.append(loss)
-				message = 'Step {:7d} [{:.3f} sec/step, loss={:.5f}, avg_loss={:.5f}]'.format(
-					step, time_window.average, loss, loss_window.average)
+				#The tf.data pipeline does not report its waits
+				dequeue_wait = feeder.take_dequeue_wait()
+				if dequeue_wait is not None:
+					wait_window.append(dequeue_wait)
+				for window, value in zip((utterance_window, token_window, frame_window, padded_token_window, padded_frame_window),
+						np.sum([batch_composition(*r['composition']) for r in batch_results], axis=0)):
+					window.append(value)
+				frames_per_sec = frame_window.sum / time_window.sum
+				waiting = '{:.3f} sec/step waiting for data, '.format(wait_window.average) if wait_window.count > 0 else ''
+				message = 'Step {:7d} [{:.3f} sec/step, {}{:.0f} frames/sec, loss={:.5f}, avg_loss={:.5f}]'.format(
+					step, time_window.average, waiting, frames_per_sec, loss, loss_window.average)
 				log(message, end='\r', slack=(step % args.checkpoint_interval == 0))
 				if loss > 100 or np.isnan(loss):
 					log('Loss exploded to {:.5f} at step {}'.format(loss, step))
@@ -224,7 +321,27 @@ def train(log_dir, args, hparams):
 
 				if step % args.summary_interval == 0:
 					log('\nWriting summary at step {}'.format(step))
-					summary_writer.add_summary(sess.run(stats), step)
+					summary_writer.add_summary(results['stats'], step)
+					if wait_window.count > 0:
+						summary_writer.add_summary(tf.Summary(value=[
+							tf.Summary.Value(tag='Tacotron_model/stats/dequeue_wait', simple_value=wait_window.average)]), step)
+
+					throughput = {
+						'frames_per_sec': frames_per_sec,
+						'tokens_per_sec': token_window.sum / time_window.sum,
+						'utterances_per_sec': utterance_window.sum / time_window.sum,
+						'frame_padding_waste': 1. - frame_window.sum / padded_frame_window.sum,
+						'token_padding_waste': 1. - token_window.sum / padded_token_window.sum,
+						}
+					log('Throughput over the last {} steps: {:.0f} mel frames/sec, {:.0f} input tokens/sec, {:.2f} utterances/sec, '
+						'{:.1%} of mel frames and {:.1%} of input tokens are padding'.format(time_window.count, throughput['frames_per_sec'],
+						throughput['tokens_per_sec'], throughput['utterances_per_sec'], throughput['frame_padding_waste'], throughput['token_padding_waste']))
+					summary_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag='Tacotron_model/throughput/{}'.format(name), simple_value=value)
+						for name, value in sorted(throughput.items())]), step)
+					add_feeder_stats(summary_writer, step, feeder.metrics, results.get('queue_size'), os.path.join(log_dir, 'feeder_metrics.jsonl'))
+					summary_writer.add_summary(tf.Summary(value=[
+						tf.Summary.Value(tag='Tacotron_model/artifacts/backlog', simple_value=artifacts.backlog),
+						tf.Summary.Value(tag='Tacotron_model/artifacts/dropped', simple_value=artifacts.dropped)]), step)
 
 				if step % args.eval_interval == 0:
 					#Run eval and save eval stats
@@ -253,8 +370,7 @@ def train(log_dir, args, hparams):
 							linear_losses.append(linear_loss)
 						linear_loss = sum(linear_losses) / len(linear_losses)
 
-						wav = audio.inv_linear_spectrogram(lin_p.T, hparams)
-						audio.save_wav(wav, os.path.join(eval_wav_dir, 'step-{}-eval-wave-from-linear.wav'.format(step)), sr=hparams.sample_rate)
+						artifacts.wav_from_linear(lin_p.T, os.path.join(eval_wav_dir, 'step-{}-eval-wave-from-linear.wav'.format(step)))
 
 					else:
 						for i in tqdm(range(feeder.test_steps)):
@@ -274,18 +390,17 @@ def train(log_dir, args, hparams):
 					stop_token_loss = sum(stop_token_losses) / len(stop_token_losses)
 					log('Saving eval log to {}..'.format(eval_dir))
 					#Save some log to monitor model improvement on same unseen sequence
-					wav = audio.inv_mel_spectrogram(mel_p.T, hparams)
-					audio.save_wav(wav, os.path.join(eval_wav_dir, 'step-{}-eval-wave-from-mel.wav'.format(step)), sr=hparams.sample_rate)
+					artifacts.wav_from_mel(mel_p.T, os.path.join(eval_wav_dir, 'step-{}-eval-wave-from-mel.wav'.format(step)))
 
-					plot.plot_alignment(align, os.path.join(eval_plot_dir, 'step-{}-eval-align.png'.format(step)),
+					artifacts.plot_alignment(align, os.path.join(eval_plot_dir, 'step-{}-eval-align.png'.format(step)),
 						title='{}, {}, step={}, loss={:.5f}'.format(args.model, time_string(), step, eval_loss),
 						max_len=t_len // hparams.outputs_per_step)
-					plot.plot_spectrogram(mel_p, os.path.join(eval_plot_dir, 'step-{}-eval-mel-spectrogram.png'.format(step)),
+					artifacts.plot_spectrogram(mel_p, os.path.join(eval_plot_dir, 'step-{}-eval-mel-spectrogram.png'.format(step)),
 						title='{}, {}, step={}, loss={:.5f}'.format(args.model, time_string(), step, eval_loss), target_spectrogram=mel_t,
 						max_len=t_len)
 
 					if hparams.predict_linear:
-						plot.plot_spectrogram(lin_p, os.path.join(eval_plot_dir, 'step-{}-eval-linear-spectrogram.png'.format(step)),
+						artifacts.plot_spectrogram(lin_p, os.path.join(eval_plot_dir, 'step-{}-eval-linear-spectrogram.png'.format(step)),
 							title='{}, {}, step={}, loss={:.5f}'.format(args.model, time_string(), step, eval_loss), target_spectrogram=lin_t,
 							max_len=t_len, auto_aspect=True)
 
@@ -294,58 +409,42 @@ def train(log_dir, args, hparams):
 					add_eval_stats(summary_writer, step, linear_loss, before_loss, after_loss, stop_token_loss, eval_loss)
 
 
-				if step % args.checkpoint_interval == 0 or step == args.tacotron_train_steps or step == 300:
+				if is_checkpoint_step(step):
 					#Save model and current global step
-					saver.save(sess, checkpoint_path, global_step=global_step)
+					save_checkpoint(sess)
 
 					log('\nSaving alignment, Mel-Spectrograms and griffin-lim inverted waveform..')
+					input_seq, mel_prediction, alignment, target, target_length = [results['diagnostics'][name]
+						for name in ('input_seq', 'mel_prediction', 'alignment', 'target', 'target_length')]
 					if hparams.predict_linear:
-						input_seq, mel_prediction, linear_prediction, alignment, target, target_length, linear_target = sess.run([
-							model.tower_inputs[0][0],
-							model.tower_mel_outputs[0][0],
-							model.tower_linear_outputs[0][0],
-							model.tower_alignments[0][0],
-							model.tower_mel_targets[0][0],
-							model.tower_targets_lengths[0][0],
-							model.tower_linear_targets[0][0],
-							])
+						linear_prediction, linear_target = results['diagnostics']['linear_prediction'], results['diagnostics']['linear_target']
 
 						#save predicted linear spectrogram to disk (debug)
 						linear_filename = 'linear-prediction-step-{}.npy'.format(step)
 						np.save(os.path.join(linear_dir, linear_filename), linear_prediction.T, allow_pickle=False)
 
 						#save griffin lim inverted wav for debug (linear -> wav)
-						wav = audio.inv_linear_spectrogram(linear_prediction.T, hparams)
-						audio.save_wav(wav, os.path.join(wav_dir, 'step-{}-wave-from-linear.wav'.format(step)), sr=hparams.sample_rate)
+						artifacts.wav_from_linear(linear_prediction.T, os.path.join(wav_dir, 'step-{}-wave-from-linear.wav'.format(step)))
 
 						#Save real and predicted linear-spectrogram plot to disk (control purposes)
-						plot.plot_spectrogram(linear_prediction, os.path.join(plot_dir, 'step-{}-linear-spectrogram.png'.format(step)),
+						artifacts.plot_spectrogram(linear_prediction, os.path.join(plot_dir, 'step-{}-linear-spectrogram.png'.format(step)),
 							title='{}, {}, step={}, loss={:.5f}'.format(args.model, time_string(), step, loss), target_spectrogram=linear_target,
 							max_len=target_length, auto_aspect=True)
 
-					else:
-						input_seq, mel_prediction, alignment, target, target_length = sess.run([
-							model.tower_inputs[0][0],
-							model.tower_mel_outputs[0][0],
-							model.tower_alignments[0][0],
-							model.tower_mel_targets[0][0],
-							model.tower_targets_lengths[0][0],
-							])
 
 					#save predicted mel spectrogram to disk (debug)
 					mel_filename = 'mel-prediction-step-{}.npy'.format(step)
 					np.save(os.path.join(mel_dir, mel_filename), mel_prediction.T, allow_pickle=False)
 
 					#save griffin lim inverted wav for debug (mel -> wav)
-					wav = audio.inv_mel_spectrogram(mel_prediction.T, hparams)
-					audio.save_wav(wav, os.path.join(wav_dir, 'step-{}-wave-from-mel.wav'.format(step)), sr=hparams.sample_rate)
+					artifacts.wav_from_mel(mel_prediction.T, os.path.join(wav_dir, 'step-{}-wave-from-mel.wav'.format(step)))
 
 					#save alignment plot to disk (control purposes)
-					plot.plot_alignment(alignment, os.path.join(plot_dir, 'step-{}-align.png'.format(step)),
+					artifacts.plot_alignment(alignment, os.path.join(plot_dir, 'step-{}-align.png'.format(step)),
 						title='{}, {}, step={}, loss={:.5f}'.format(args.model, time_string(), step, loss),
 						max_len=target_length // hparams.outputs_per_step)
 					#save real and predicted mel-spectrogram plot to disk (control purposes)
-					plot.plot_spectrogram(mel_prediction, os.path.join(plot_dir, 'step-{}-mel-spectrogram.png'.format(step)),
+					artifacts.plot_spectrogram(mel_prediction, os.path.join(plot_dir, 'step-{}-mel-spectrogram.png'.format(step)),
 						title='{}, {}, step={}, loss={:.5f}'.format(args.model, time_string(), step, loss), target_spectrogram=target,
 						max_len=target_length)
 					log('Input at step {}: {}'.format(step, sequence_to_text(input_seq)))
@@ -368,5 +467,14 @@ def train(log_dir, args, hparams):
 			traceback.print_exc()
 			coord.request_stop(e)
 
+		finally:
+			#Stop the loading worker processes
+			feeder.close()
+			#Pending checkpoints are completely written before the session closes
+			if async_saver is not None:
+				async_saver.close()
+			if artifacts is not None:
+				artifacts.close()
+
 def tacotron_train(args, log_dir, hparams):
 	return train(log_dir, args, hparams)
@@ -0,0 +1,49 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+  '''Least recently used cache bounded by the total size (in bytes) of its values.
+
+    Entries are evicted oldest use first once the budget is exceeded. A value larger than
+    the whole budget is never stored. Safe to share between threads.
+  '''
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    '''Returns the value cached under key (marking it as recently used), or None'''
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key, value, nbytes):
+    if nbytes > self.max_bytes:
+      return
+    with self._lock:
+      previous = self._entries.pop(key, None)
+      if previous is not None:
+        self.bytes -= previous[1]
+      self._entries[key] = (value, nbytes)
+      self.bytes += nbytes
+      while self.bytes > self.max_bytes:
+        _, (_, evicted_bytes) = self._entries.popitem(last=False)
+        self.bytes -= evicted_bytes
+
+  def __len__(self):
+    return len(self._entries)
+
+  @property
+  def hit_rate(self):
+    return self.hits / max(1, self.hits + self.misses)
@@ -0,0 +1,74 @@
+import json
+import os
+import re
+from collections import defaultdict
+
+#compute_gradients runs in the 'optimizer' variable scope of each tower (name scopes optimizer, optimizer_1, ..)
+_optimizer_scope = re.compile(r'^optimizer(_\d+)?$')
+_gradients_scope = re.compile(r'^gradients(_\d+)?$')
+
+
+def scope_of(node_name, model_scope='Tacotron_model', depth=2):
+	"""Maps an op name to the model scope it is reported under
+
+	'Tacotron_model/inference/decoder/while/...' -> 'inference/decoder', the backward ops of a scope
+	('Tacotron_model/optimizer_1/gradients/Tacotron_model/inference/decoder/...') -> 'gradients/inference/decoder'
+	and the other ops of the towers optimizer scopes ('Tacotron_model/optimizer_1/...') -> 'optimizer/...'.
+	"""
+	#Stream stats name nodes as 'name:OpType'
+	parts = node_name.split(':')[0].split('/')
+	if parts[0] == model_scope:
+		parts = parts[1:]
+	if parts and _optimizer_scope.match(parts[0]):
+		parts = ['optimizer'] + parts[1:]
+	prefix = []
+	if len(parts) > 1 and parts[0] == 'optimizer' and _gradients_scope.match(parts[1]):
+		parts = parts[1:]
+	if parts and _gradients_scope.match(parts[0]):
+		prefix, parts = ['gradients'], parts[1:]
+		if parts and parts[0] == model_scope:
+			parts = parts[1:]
+	return '/'.join(prefix + parts[:depth]) or node_name
+
+def scope_report(step_stats, depth=2):
+	"""Aggregates the op times and output allocations of a traced run by device and model scope
+
+	Args:
+		- step_stats: StepStats of the RunMetadata of a run traced with FULL_TRACE
+		- depth: number of scope levels (after the model scope) ops are grouped by
+
+	Returns:
+		- {device: {scope: {'ops', 'time_ms', 'output_mb', 'peak_mb'}}}, scopes sorted by decreasing time
+	"""
+	report = {}
+	for device_stats in step_stats.dev_stats:
+		device = device_stats.device
+		#GPU kernels are reported on each stream and again on 'stream:all', only the latter is kept
+		if '/stream:' in device and not device.endswith('/stream:all'):
+			continue
+		scopes = defaultdict(lambda: {'ops': 0, 'time_ms': 0., 'output_mb': 0., 'peak_mb': 0.})
+		for node in device_stats.node_stats:
+			stats = scopes[scope_of(node.node_name, depth=depth)]
+			stats['ops'] += 1
+			stats['time_ms'] += node.all_end_rel_micros / 1000.
+			stats['output_mb'] += sum(output.tensor_description.allocation_description.requested_bytes
+				for output in node.output) / 1024. ** 2
+			stats['peak_mb'] = max([stats['peak_mb']] + [memory.peak_bytes / 1024. ** 2 for memory in node.memory])
+		report[device] = dict(sorted(scopes.items(), key=lambda item: -item[1]['time_ms']))
+	return report
+
+def write_profile(run_metadata, profile_dir, step, summary_writer=None):
+	"""Writes the chrome trace (timeline-step-N.json) and the per scope report (scopes-step-N.json) of a traced run
+
+	The trace opens in chrome://tracing, reports of different runs can be diffed directly.
+	"""
+	from tensorflow.python.client import timeline
+	os.makedirs(profile_dir, exist_ok=True)
+	trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format(show_memory=True)
+	with open(os.path.join(profile_dir, 'timeline-step-{}.json'.format(step)), 'w') as f:
+		f.write(trace)
+	with open(os.path.join(profile_dir, 'scopes-step-{}.json'.format(step)), 'w') as f:
+		json.dump(scope_report(run_metadata.step_stats), f, indent=2)
+
+	if summary_writer is not None:
+		summary_writer.add_run_metadata(run_metadata, 'step-{}'.format(step), step)
@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+from datasets import feature_store
+
+
+def _write_shard(directory, arrays):
+	writer = feature_store.ShardWriter(directory, 1 << 20)
+	for key, array in arrays:
+		writer.write(key, array)
+	writer.close()
+
+def test_shards_without_live_entries_are_removed(tmp_path):
+	directory = str(tmp_path)
+	_write_shard(directory, [('a.npy', np.zeros(4, np.float32)), ('b.npy', np.ones(4, np.float32))])
+	#Shards of an earlier run sort first
+	for name in os.listdir(directory):
+		os.rename(os.path.join(directory, name), os.path.join(directory, name.replace('shard-', 'shard-0-', 1)))
+	#A later run extracts a.npy again and drops b.npy, the first shard has no live entry left
+	_write_shard(directory, [('a.npy', np.full(4, 2, np.float32))])
+
+	removed, removed_bytes = feature_store.remove_unreferenced(directory, {'a.npy'})
+	assert removed == 1 and removed_bytes > 0
+
+	reader = feature_store.FeatureReader(directory)
+	assert 'a.npy' in reader and 'b.npy' not in reader
+	assert (reader.load('a.npy') == 2).all()
+
+def test_shards_with_live_entries_are_kept(tmp_path):
+	directory = str(tmp_path)
+	_write_shard(directory, [('a.npy', np.zeros(4, np.float32)), ('b.npy', np.ones(4, np.float32))])
+
+	removed, _ = feature_store.remove_unreferenced(directory, {'b.npy'})
+	assert removed == 0
+	assert (feature_store.FeatureReader(directory).load('a.npy') == 0).all()
@@ -0,0 +1,19 @@
+from tacotron.utils.profiling import scope_of
+
+
+def test_forward_ops_are_grouped_by_model_scope():
+	assert scope_of('Tacotron_model/inference/encoder_convolutions/conv_layer_1_encoder_convolutions/conv1d/Conv2D') == 'inference/encoder_convolutions'
+	assert scope_of('Tacotron_model/inference/decoder/while/CustomDecoderStep/decoder_LSTM/MatMul:MatMul') == 'inference/decoder'
+
+def test_tower_gradient_ops_are_grouped_by_forward_scope():
+	#compute_gradients of tower i runs in the 'optimizer' variable scope (name scope optimizer_i)
+	assert scope_of('Tacotron_model/optimizer_1/gradients/Tacotron_model/inference/decoder/while/CustomDecoderStep/'
+		'decoder_LSTM/MatMul_grad/MatMul_1') == 'gradients/inference/decoder'
+	assert scope_of('Tacotron_model/optimizer/gradients/Tacotron_model/inference/encoder_convolutions/conv_layer_1_encoder_convolutions/'
+		'conv1d/Conv2D_grad/Conv2DBackpropInput:Conv2DBackpropInput') == 'gradients/inference/encoder_convolutions'
+
+def test_optimizer_ops_of_all_towers_share_a_scope():
+	assert scope_of('Tacotron_model/optimizer_2/Adam/update_Tacotron_model/inference/inputs_embedding/ApplyAdam') == 'optimizer/Adam'
+
+def test_ops_outside_the_model_keep_their_name():
+	assert scope_of('_SOURCE') == '_SOURCE'
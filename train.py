@@ -62,6 +62,12 @@ def main():
 		help='Steps between writing checkpoints')
 	parser.add_argument('--eval_interval', type=int, default=10000,
 		help='Steps between eval on test data')
+	parser.add_argument('--profile_interval', type=int, default=0,
+		help='Steps between traced training steps (timeline and per scope time/memory report), 0 to disable')
+	parser.add_argument('--async_checkpoints', action='store_true',
+		help='Snapshot the variables at checkpoint steps and write the checkpoints from a background thread')
+	parser.add_argument('--artifact_queue_size', type=int, default=8,
+		help='Maximum number of pending Griffin-Lim/plot jobs before new ones are dropped')
 	parser.add_argument('--tacotron_train_steps', type=int, default=150000, help='total number of tacotron training steps')
 	parser.add_argument('--wavenet_train_steps', type=int, default=750000, help='total number of wavenet training steps')
 	parser.add_argument('--tf_log_level', type=int, default=1, help='Tensorflow C++ log level.')